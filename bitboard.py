@@ -0,0 +1,326 @@
+"""Bitboard representation of chess positions.
+
+Squares are numbered from 0 (A1) to 63 (H8).  Board coordinates are the
+(file, rank) pairs used by chess.py, where rank 0 is the eighth rank.
+"""
+import random
+
+WHITE, BLACK = 0, 1
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+
+COLORS = ('white', 'black')
+PIECE_TYPES = ('pawn', 'knight', 'bishop', 'rook', 'queen', 'king')
+COLOR_INDEX = dict((color, i) for i, color in enumerate(COLORS))
+TYPE_INDEX = dict((piece_type, i) for i, piece_type in enumerate(PIECE_TYPES))
+
+ALL = (1 << 64) - 1
+FILE_A = 0x0101010101010101
+RANK_1 = 0xff
+DARK_SQUARES = 0xaa55aa55aa55aa55
+LIGHT_SQUARES = ALL ^ DARK_SQUARES
+
+
+def square(coords):
+	"""Convert (file, rank) board coordinates to a square number."""
+	return coords[0] + 8 * (7 - coords[1])
+
+
+def coords(sq):
+	"""Convert a square number to (file, rank) board coordinates."""
+	return sq & 7, 7 - (sq >> 3)
+
+
+def lsb(bb):
+	"""Return the lowest square set in a bitboard."""
+	return (bb & -bb).bit_length() - 1
+
+
+def msb(bb):
+	"""Return the highest square set in a bitboard."""
+	return bb.bit_length() - 1
+
+
+def squares(bb):
+	"""Iterate over the squares set in a bitboard, lowest first."""
+	while bb:
+		low = bb & -bb
+		yield low.bit_length() - 1
+		bb ^= low
+
+
+def popcount(bb):
+	return bin(bb).count('1')
+
+
+def _on_board(file, rank):
+	return 0 <= file < 8 and 0 <= rank < 8
+
+
+def _leaper_table(deltas):
+	table = []
+	for sq in range(64):
+		file, rank = sq & 7, sq >> 3
+		bb = 0
+		for file_add, rank_add in deltas:
+			o_file, o_rank = file + file_add, rank + rank_add
+			if _on_board(o_file, o_rank):
+				bb |= 1 << (o_file + 8 * o_rank)
+		table.append(bb)
+	return table
+
+
+def _ray_table(file_add, rank_add):
+	table = []
+	for sq in range(64):
+		o_file, o_rank = (sq & 7) + file_add, (sq >> 3) + rank_add
+		bb = 0
+		while _on_board(o_file, o_rank):
+			bb |= 1 << (o_file + 8 * o_rank)
+			o_file, o_rank = o_file + file_add, o_rank + rank_add
+		table.append(bb)
+	return table
+
+
+KNIGHT_ATTACKS = _leaper_table([(1, 2), (2, 1), (2, -1), (1, -2),
+			(-1, -2), (-2, -1), (-2, 1), (-1, 2)])
+KING_ATTACKS = _leaper_table([(-1, -1), (-1, 0), (-1, 1), (0, -1),
+			(0, 1), (1, -1), (1, 0), (1, 1)])
+PAWN_ATTACKS = (_leaper_table([(-1, 1), (1, 1)]),
+		_leaper_table([(-1, -1), (1, -1)]))
+
+NORTH, SOUTH = _ray_table(0, 1), _ray_table(0, -1)
+EAST, WEST = _ray_table(1, 0), _ray_table(-1, 0)
+NORTH_EAST, NORTH_WEST = _ray_table(1, 1), _ray_table(-1, 1)
+SOUTH_EAST, SOUTH_WEST = _ray_table(1, -1), _ray_table(-1, -1)
+
+# Rays pointing towards higher square numbers are cut at their lowest
+# blocker, the others at their highest.
+ROOK_RAYS = ((NORTH, True), (EAST, True), (SOUTH, False), (WEST, False))
+BISHOP_RAYS = ((NORTH_EAST, True), (NORTH_WEST, True),
+		(SOUTH_EAST, False), (SOUTH_WEST, False))
+
+
+def _slide(sq, occupied, rays):
+	attacks = 0
+	for table, positive in rays:
+		ray = table[sq]
+		blockers = ray & occupied
+		if blockers:
+			if positive:
+				ray ^= table[(blockers & -blockers).bit_length() - 1]
+			else:
+				ray ^= table[blockers.bit_length() - 1]
+		attacks |= ray
+	return attacks
+
+
+def rook_attacks(sq, occupied):
+	"""Return the squares a rook on sq attacks, given the occupied squares."""
+	return _slide(sq, occupied, ROOK_RAYS)
+
+
+def bishop_attacks(sq, occupied):
+	"""Return the squares a bishop on sq attacks, given the occupied squares."""
+	return _slide(sq, occupied, BISHOP_RAYS)
+
+
+def queen_attacks(sq, occupied):
+	"""Return the squares a queen on sq attacks, given the occupied squares."""
+	return _slide(sq, occupied, ROOK_RAYS) | _slide(sq, occupied, BISHOP_RAYS)
+
+
+def _between_table():
+	table = [[0] * 64 for _ in range(64)]
+	for rays in ROOK_RAYS, BISHOP_RAYS:
+		for ray_table, positive in rays:
+			for source in range(64):
+				for dest in squares(ray_table[source]):
+					table[source][dest] = (ray_table[source] &
+								~ray_table[dest] &
+								~(1 << dest))
+	return table
+
+
+BETWEEN = _between_table()
+
+
+def between(source, dest):
+	"""Return the squares strictly between two squares on a common line.
+
+	Returns an empty bitboard if the squares do not share a rank, file or
+	diagonal."""
+	return BETWEEN[source][dest]
+
+
+_zobrist_random = random.Random(20090)
+ZOBRIST_PIECES = [[[_zobrist_random.getrandbits(64) for sq in range(64)]
+			for piece_type in range(6)] for color in range(2)]
+ZOBRIST_BLACK = _zobrist_random.getrandbits(64)
+ZOBRIST_CASTLING = [_zobrist_random.getrandbits(64) for rights in range(16)]
+ZOBRIST_EN_PASSANT = [_zobrist_random.getrandbits(64) for file in range(8)]
+
+
+class Position(object):
+	"""A chess position stored as one bitboard per color and piece type."""
+
+	def __init__(self):
+		self.pieces = [[0] * 6, [0] * 6]
+		self.occupancy = [0, 0]
+
+	@classmethod
+	def from_board(cls, board):
+		"""Create a position from a list-of-lists board of chess.Piece."""
+		position = cls()
+		for file, col in enumerate(board):
+			for rank, piece in enumerate(col):
+				if piece:
+					position.put(square((file, rank)),
+						piece.side, piece.kind)
+		return position
+
+	def to_board(self):
+		"""Create a chess.Board holding this position's pieces."""
+		from chess import Board, Piece
+		board = [[None] * 8 for _ in range(8)]
+		for color in WHITE, BLACK:
+			for piece_type, bb in enumerate(self.pieces[color]):
+				for sq in squares(bb):
+					file, rank = coords(sq)
+					board[file][rank] = Piece(COLORS[color],
+								PIECE_TYPES[piece_type])
+		return Board(board)
+
+	def copy(self):
+		position = type(self).__new__(type(self))
+		position.pieces = [self.pieces[WHITE][:], self.pieces[BLACK][:]]
+		position.occupancy = self.occupancy[:]
+		return position
+
+	@property
+	def occupied(self):
+		return self.occupancy[WHITE] | self.occupancy[BLACK]
+
+	def put(self, sq, color, piece_type):
+		"""Place a piece on an empty square."""
+		bit = 1 << sq
+		self.pieces[color][piece_type] |= bit
+		self.occupancy[color] |= bit
+
+	def remove(self, sq, color, piece_type):
+		"""Remove a piece from the square it occupies."""
+		mask = ~(1 << sq)
+		self.pieces[color][piece_type] &= mask
+		self.occupancy[color] &= mask
+
+	def piece_at(self, sq):
+		"""Return the (color, piece_type) on a square, or None if it is empty."""
+		bit = 1 << sq
+		for color in WHITE, BLACK:
+			if self.occupancy[color] & bit:
+				for piece_type, bb in enumerate(self.pieces[color]):
+					if bb & bit:
+						return color, piece_type
+		return None
+
+	def zobrist(self):
+		"""Return the Zobrist hash of the pieces in this position."""
+		key = 0
+		for color in WHITE, BLACK:
+			for piece_type, bb in enumerate(self.pieces[color]):
+				keys = ZOBRIST_PIECES[color][piece_type]
+				for sq in squares(bb):
+					key ^= keys[sq]
+		return key
+
+	def king_square(self, color):
+		"""Return the square of this color's king, or None if it has none."""
+		kings = self.pieces[color][KING]
+		return lsb(kings) if kings else None
+
+	def is_blocked(self, source, dest):
+		"""Check whether any piece stands strictly between two squares."""
+		return bool(BETWEEN[source][dest] & self.occupied)
+
+	def attacks_from(self, sq, color, piece_type, occupied=None):
+		"""Return the squares attacked by the given piece standing on sq."""
+		if occupied is None:
+			occupied = self.occupied
+		if piece_type == PAWN:
+			return PAWN_ATTACKS[color][sq]
+		elif piece_type == KNIGHT:
+			return KNIGHT_ATTACKS[sq]
+		elif piece_type == BISHOP:
+			return bishop_attacks(sq, occupied)
+		elif piece_type == ROOK:
+			return rook_attacks(sq, occupied)
+		elif piece_type == QUEEN:
+			return queen_attacks(sq, occupied)
+		return KING_ATTACKS[sq]
+
+	def attackers_to(self, sq, color, occupied=None):
+		"""Return the pieces of the given color that attack sq."""
+		if occupied is None:
+			occupied = self.occupied
+		pieces = self.pieces[color]
+		queens = pieces[QUEEN]
+		return ((PAWN_ATTACKS[color ^ 1][sq] & pieces[PAWN]) |
+			(KNIGHT_ATTACKS[sq] & pieces[KNIGHT]) |
+			(KING_ATTACKS[sq] & pieces[KING]) |
+			(bishop_attacks(sq, occupied) & (pieces[BISHOP] | queens)) |
+			(rook_attacks(sq, occupied) & (pieces[ROOK] | queens)))
+
+	def is_attacked(self, sq, color):
+		"""Check whether any piece of the given color attacks sq."""
+		pieces = self.pieces[color]
+		if PAWN_ATTACKS[color ^ 1][sq] & pieces[PAWN]:
+			return True
+		if KNIGHT_ATTACKS[sq] & pieces[KNIGHT]:
+			return True
+		if KING_ATTACKS[sq] & pieces[KING]:
+			return True
+		occupied = self.occupied
+		queens = pieces[QUEEN]
+		if (pieces[BISHOP] | queens) and (bishop_attacks(sq, occupied) &
+						(pieces[BISHOP] | queens)):
+			return True
+		if (pieces[ROOK] | queens) and (rook_attacks(sq, occupied) &
+						(pieces[ROOK] | queens)):
+			return True
+		return False
+
+	def attacks(self, color):
+		"""Return every square attacked by the given color."""
+		occupied = self.occupied
+		attacked = 0
+		for piece_type, bb in enumerate(self.pieces[color]):
+			for sq in squares(bb):
+				attacked |= self.attacks_from(sq, color, piece_type, occupied)
+		return attacked
+
+	def in_check(self, color):
+		"""Check whether the king of the given color is under attack."""
+		king = self.king_square(color)
+		return king is not None and self.is_attacked(king, color ^ 1)
+
+	def __eq__(self, other):
+		return (isinstance(other, Position) and
+			self.pieces == other.pieces)
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __repr__(self):
+		symbols = 'PNBRQK'
+		rows = []
+		for rank in range(7, -1, -1):
+			row = ''
+			for file in range(8):
+				piece = self.piece_at(file + 8 * rank)
+				if piece is None:
+					row += '.'
+				else:
+					color, piece_type = piece
+					symbol = symbols[piece_type]
+					row += symbol if color == WHITE else symbol.lower()
+			rows.append(row)
+		return '\n'.join(rows)
@@ -1,18 +1,31 @@
 #!/usr/bin/python3
-import pygame
-from os import path
+"""The rules of chess, independent of any display."""
+import bitboard
+import evaluation
+from bitboard import square, coords, squares
+from bitboard import WHITE, BLACK, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING
 from warnings import warn
+from collections import OrderedDict
+import struct
+import re
 
-pieces = ['rook', 'knight', 'bishop', 'king',
-	'queen', 'bishop', 'knight', 'rook']
+pieces = ['rook', 'knight', 'bishop', 'queen',
+	'king', 'bishop', 'knight', 'rook']
 pawns = ['pawn'] * 8
+promotions = ['queen', 'knight', 'rook', 'bishop']
+castles = [('white', (4, 7), (7, 7)), ('white', (4, 7), (0, 7)),
+	('black', (4, 0), (7, 0)), ('black', (4, 0), (0, 0))]
+castle_masks = [15] * 64
+for bit, (_, king_loc, rook_loc) in enumerate(castles):
+	for loc in king_loc, rook_loc:
+		castle_masks[square(loc)] &= ~(1 << bit)
 
 
 def new_board():
 	"""Create a new list-of-lists to populate the piece layer with."""
 	new_board = []
 	new_board.append([Piece('white', piece)
-			for piece in reversed(pieces)])
+			for piece in pieces])
 	new_board.append([Piece('white', piece)
 			for piece in pawns])
 	new_board.extend([[None] * 8] * 4)
@@ -21,7 +34,179 @@ def new_board():
 	new_board.append([Piece('black', piece)
 			for piece in pieces])
 	new_board = list(map(list, zip(*new_board[::-1])))
-	return new_board
+	return Board(new_board)
+
+
+san_pattern = re.compile(
+		r'^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?$')
+
+fen_symbols = {'p': 'pawn', 'n': 'knight', 'b': 'bishop',
+	'r': 'rook', 'q': 'queen', 'k': 'king'}
+
+
+def board_from_fen(fen):
+	"""Create a board from a FEN string.
+
+	The halfmove and fullmove clocks may be left out."""
+	fields = fen.split()
+	if len(fields) < 4:
+		raise ValueError("Malformed FEN: " + fen)
+	placement, turn, castling_field, ep = fields[:4]
+	rows = placement.split('/')
+	if len(rows) != 8 or turn not in 'wb':
+		raise ValueError("Malformed FEN: " + fen)
+	board = [[None] * 8 for _ in range(8)]
+	for rank, row in enumerate(rows):
+		file = 0
+		for char in row:
+			if char.isdigit():
+				file += int(char)
+			elif char.lower() in fen_symbols and file < 8:
+				color = 'white' if char.isupper() else 'black'
+				board[file][rank] = Piece(color, fen_symbols[char.lower()])
+				file += 1
+			else:
+				raise ValueError("Malformed FEN: " + fen)
+		if file != 8:
+			raise ValueError("Malformed FEN: " + fen)
+	castling = 0
+	if castling_field != '-':
+		for char in castling_field:
+			if char not in 'KQkq':
+				raise ValueError("Invalid castling rights: " + castling_field)
+			castling |= 1 << 'KQkq'.index(char)
+	ep_square = None
+	if ep != '-':
+		if (len(ep) != 2 or ep[0] not in 'abcdefgh' or
+				ep[1] not in '36'):
+			raise ValueError("Invalid en passant square: " + ep)
+		ep_square = 'abcdefgh'.index(ep[0]), 8 - int(ep[1])
+	try:
+		halfmove = int(fields[4]) if len(fields) > 4 else 0
+		fullmove = int(fields[5]) if len(fields) > 5 else 1
+	except ValueError:
+		raise ValueError("Malformed FEN: " + fen)
+	return Board(board, 'white' if turn == 'w' else 'black', castling,
+			ep_square, halfmove, fullmove)
+
+
+def board_to_fen(board, clocks=True):
+	"""Return the FEN string of a board.
+
+	If clocks is false, the halfmove and fullmove fields are left out."""
+	rows = []
+	for rank in range(8):
+		row, empty = '', 0
+		for file in range(8):
+			piece = board[file][rank]
+			if piece is None:
+				empty += 1
+				continue
+			if empty:
+				row += str(empty)
+				empty = 0
+			symbol = 'pnbrqk'[piece.kind]
+			row += symbol.upper() if piece.side == WHITE else symbol
+		if empty:
+			row += str(empty)
+		rows.append(row)
+	castling = ''.join(char for i, char in enumerate('KQkq')
+			if board.castling & (1 << i)) or '-'
+	if board.ep_square is None:
+		ep = '-'
+	else:
+		ep = 'abcdefgh'[board.ep_square[0]] + str(8 - board.ep_square[1])
+	fields = ['/'.join(rows), board.turn[0], castling, ep]
+	if clocks:
+		fields += [str(board.halfmove), str(board.fullmove)]
+	return ' '.join(fields)
+
+
+epd_operation = re.compile(
+		r'\s*([A-Za-z]\w*)((?:\s+(?:"[^"]*"|[^\s;"]+))*)\s*;')
+epd_operand = re.compile(r'"([^"]*)"|([^\s;"]+)')
+
+
+def board_from_epd(epd):
+	"""Create a board from an EPD line.
+
+	Returns the board and an OrderedDict mapping each opcode to its list
+	of operands, with quotes removed.  The hmvc and fmvn operations, if
+	present, set the board's clocks."""
+	fields = epd.split(None, 4)
+	if len(fields) < 4:
+		raise ValueError("Malformed EPD: " + epd)
+	board = board_from_fen(' '.join(fields[:4]))
+	operations = OrderedDict()
+	rest = fields[4] if len(fields) > 4 else ''
+	pos = 0
+	while rest[pos:].strip():
+		match = epd_operation.match(rest, pos)
+		if not match:
+			raise ValueError("Malformed EPD operations: " + rest)
+		operations[match.group(1)] = [quoted or bare for quoted, bare
+				in epd_operand.findall(match.group(2))]
+		pos = match.end()
+	try:
+		if 'hmvc' in operations:
+			board.halfmove = int(operations['hmvc'][0])
+		if 'fmvn' in operations:
+			board.fullmove = int(operations['fmvn'][0])
+	except (IndexError, ValueError):
+		raise ValueError("Malformed EPD clocks: " + epd)
+	return board, operations
+
+
+def board_to_epd(board, operations=None):
+	"""Return the EPD line of a board, followed by any operations.
+
+	operations maps opcodes to lists of operands; operands containing
+	spaces are quoted."""
+	line = board_to_fen(board, clocks=False)
+	for opcode, operands in (operations or {}).items():
+		line += ' ' + opcode
+		for operand in operands:
+			operand = str(operand)
+			if not operand or ' ' in operand or ';' in operand:
+				operand = '"' + operand + '"'
+			line += ' ' + operand
+		line += ';'
+	return line
+
+
+# Binary positions: the occupied squares, then a 4-bit piece code for each
+# occupied square in order, then the turn and castling bits, the en passant
+# square plus one (or 0), and the two clocks.
+packed_board = struct.Struct('<Q16sBBHH2x')
+PACKED_SIZE = packed_board.size
+
+
+def board_to_bytes(board):
+	"""Encode a board in PACKED_SIZE (32) bytes."""
+	occupied = board.position.occupied
+	codes = bytearray(16)
+	for i, sq in enumerate(squares(occupied)):
+		if i == 32:
+			raise ValueError("Too many pieces to encode")
+		file, rank = coords(sq)
+		codes[i >> 1] |= board[file][rank].code << (4 * (i & 1))
+	flags = (board.turn == 'black') | (board.castling << 1)
+	ep = 0 if board.ep_square is None else square(board.ep_square) + 1
+	return packed_board.pack(occupied, bytes(codes), flags, ep,
+			min(board.halfmove, 0xffff), min(board.fullmove, 0xffff))
+
+
+def board_from_bytes(data):
+	"""Create a board from the output of board_to_bytes()."""
+	occupied, codes, flags, ep, halfmove, fullmove = packed_board.unpack(data)
+	codes = bytearray(codes)
+	board = [[None] * 8 for _ in range(8)]
+	for i, sq in enumerate(squares(occupied)):
+		code = (codes[i >> 1] >> (4 * (i & 1))) & 15
+		file, rank = coords(sq)
+		board[file][rank] = Piece.from_code(code)
+	return Board(board, 'black' if flags & 1 else 'white', flags >> 1,
+			coords(ep - 1) if ep else None, halfmove, fullmove)
 
 
 def irange(start, end):
@@ -40,59 +225,394 @@ def coord_range(source, dest):
 	#next(gen)
 	return gen
 
-main_file = __file__
-realpath = path.realpath(main_file)
-realpath_dir = path.dirname(realpath)
-
-
 class Piece(object):
-	"""A chess piece."""
+	"""A chess piece.
 
+	There is one shared instance per color and piece type, so pieces hold
+	no per-square state and can be compared by identity.  side, kind and
+	code are the color, type and both together as small integers."""
+
+	__slots__ = ('color', 'piece_type', 'side', 'kind', 'code')
+	instances = {}
+	by_code = [None] * 12
 	textures = {}
+	texture_loader = None
 
-	def __init__(self, color, piece_type):
-		self.color, self.piece_type = color, piece_type
-		if (color, piece_type) not in self.textures:
-			texture_path = "chess_textures/{}{}.png".format(color[0], piece_type)
-			full_path = path.join(realpath_dir, texture_path)
-			self.textures[color, piece_type] = pygame.image.load(full_path)
-		self.surface = self.textures[color, piece_type]
-		if piece_type in ('pawn', 'rook', 'king'):
-			self.moved = False
-		if piece_type == 'pawn':
-			self.two_space = False
+	def __new__(cls, color, piece_type):
+		try:
+			return cls.instances[color, piece_type]
+		except KeyError:
+			pass
+		piece = object.__new__(cls)
+		piece.color, piece.piece_type = color, piece_type
+		piece.side = bitboard.COLOR_INDEX[color]
+		piece.kind = bitboard.TYPE_INDEX[piece_type]
+		piece.code = piece.side * 6 + piece.kind
+		cls.instances[color, piece_type] = piece
+		cls.by_code[piece.code] = piece
+		return piece
+
+	@classmethod
+	def from_code(cls, code):
+		"""Return the piece with the given small-integer code."""
+		return cls.by_code[code] or cls(bitboard.COLORS[code // 6],
+						bitboard.PIECE_TYPES[code % 6])
+
+	def __reduce__(self):
+		return Piece, (self.color, self.piece_type)
+
+	@property
+	def surface(self):
+		"""The texture to draw this piece with, loaded the first time it is drawn.
+
+		Textures come from Piece.texture_loader, which the rendering layer
+		installs; without one, pieces have no surface."""
+		key = self.color, self.piece_type
+		try:
+			return self.textures[key]
+		except KeyError:
+			pass
+		if Piece.texture_loader is None:
+			raise AttributeError('surface')
+		surface = self.textures[key] = Piece.texture_loader(*key)
+		return surface
 
 	def __repr__(self):
 		return "{} {}".format(self.color, self.piece_type)
 
 
+class Board(list):
+	"""A list-of-lists board that mirrors its pieces in a bitboard Position.
+
+	Moves made with Move.make and Move.unmake keep the mirror and the
+	cached king locations up to date, so a check test is a few bitboard
+	operations on the king's square rather than a scan of the board.
+
+	The board also holds the state that is not visible in the pieces:
+	the side to move, the castling rights as bits in KQkq order, the
+	square a pawn may capture onto en passant (or None), and the
+	halfmove and fullmove clocks.  If castling is None, every castle
+	whose king and rook stand on their starting squares is allowed.
+
+	mg, eg and phase hold the evaluation terms described in evaluation.py,
+	and are updated along with the mirror."""
+
+	def __init__(self, columns=(), turn='white', castling=None,
+			ep_square=None, halfmove=0, fullmove=1):
+		list.__init__(self, columns)
+		self.turn = turn
+		self.castling = castling
+		self.ep_square = ep_square
+		self.halfmove, self.fullmove = halfmove, fullmove
+		self.sync()
+
+	def sync(self):
+		"""Rebuild the mirrored state after the columns were edited directly."""
+		self.position = bitboard.Position.from_board(self)
+		self.kings = {}
+		for color in bitboard.COLORS:
+			sq = self.position.king_square(bitboard.COLOR_INDEX[color])
+			self.kings[color] = None if sq is None else coords(sq)
+		self.mg, self.eg, self.phase = evaluation.score(self.position)
+		self.ep_square = en_passant_square(self, self.ep_square)
+		if self.castling is None:
+			self.castling = castling_rights(self)
+		self.hash = (self.position.zobrist() ^
+			self.state_hash(self.castling, self.ep_square))
+		if self.turn == 'black':
+			self.hash ^= bitboard.ZOBRIST_BLACK
+
+	def copy(self):
+		"""Return an independent copy of this board and its state."""
+		return type(self)([col[:] for col in self], *self.state)
+
+	def set_fen(self, fen):
+		"""Replace the pieces and state in place with those of a FEN string."""
+		other = board_from_fen(fen)
+		self[:] = other
+		(self.turn, self.castling, self.ep_square, self.halfmove,
+			self.fullmove) = other.state
+		self.sync()
+
+	@property
+	def state(self):
+		"""The turn, castling, en passant and clock state, as a tuple."""
+		return (self.turn, self.castling, self.ep_square,
+			self.halfmove, self.fullmove)
+
+	@staticmethod
+	def state_hash(castling, ep_square):
+		"""Return the hash contribution of the castling and en passant state."""
+		key = bitboard.ZOBRIST_CASTLING[castling]
+		if ep_square is not None:
+			key ^= bitboard.ZOBRIST_EN_PASSANT[ep_square[0]]
+		return key
+
+	def lift(self, loc, piece):
+		"""Record that a piece has been taken off a square."""
+		sq = square(loc)
+		side, kind = piece.side, piece.kind
+		self.position.remove(sq, side, kind)
+		self.hash ^= bitboard.ZOBRIST_PIECES[side][kind][sq]
+		self.mg -= evaluation.MG_SCORES[side][kind][sq]
+		self.eg -= evaluation.EG_SCORES[side][kind][sq]
+		self.phase -= evaluation.PHASE_WEIGHTS[kind]
+
+	def drop(self, loc, piece):
+		"""Record that a piece has been placed on a square."""
+		sq = square(loc)
+		side, kind = piece.side, piece.kind
+		self.position.put(sq, side, kind)
+		self.hash ^= bitboard.ZOBRIST_PIECES[side][kind][sq]
+		self.mg += evaluation.MG_SCORES[side][kind][sq]
+		self.eg += evaluation.EG_SCORES[side][kind][sq]
+		self.phase += evaluation.PHASE_WEIGHTS[kind]
+		if kind == KING:
+			self.kings[piece.color] = loc
+
+
+class RuleCache(object):
+	"""A bounded cache of rule query results, keyed by position hash.
+
+	The least recently used entry is evicted once maxsize is reached."""
+
+	def __init__(self, maxsize=65536):
+		self.maxsize = maxsize
+		self.entries = OrderedDict()
+		self.hits = self.misses = self.evictions = 0
+
+	def get(self, key):
+		"""Return the cached result for key, or None if there is none."""
+		try:
+			value = self.entries[key]
+		except KeyError:
+			self.misses += 1
+			return None
+		self.entries.move_to_end(key)
+		self.hits += 1
+		return value
+
+	def put(self, key, value):
+		"""Cache a result, evicting the oldest entries to stay in bounds."""
+		self.entries[key] = value
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.maxsize:
+			self.entries.popitem(last=False)
+			self.evictions += 1
+
+	def resize(self, maxsize):
+		"""Change the size limit, evicting entries if it shrank."""
+		self.maxsize = maxsize
+		while len(self.entries) > maxsize:
+			self.entries.popitem(last=False)
+			self.evictions += 1
+
+	def clear(self):
+		self.entries.clear()
+		self.hits = self.misses = self.evictions = 0
+
+	@property
+	def hit_rate(self):
+		lookups = self.hits + self.misses
+		return self.hits / lookups if lookups else 0.0
+
+	@property
+	def stats(self):
+		"""Return the counters needed to size the cache."""
+		return {'size': len(self.entries), 'maxsize': self.maxsize,
+			'hits': self.hits, 'misses': self.misses,
+			'evictions': self.evictions, 'hit_rate': self.hit_rate}
+
+	def __len__(self):
+		return len(self.entries)
+
+
+rule_cache = RuleCache()
+
+
+def castling_rights(board):
+	"""Return the castles allowed by where the kings and rooks stand.
+
+	The result has a bit set, in KQkq order, for each king and rook that
+	are still on their starting squares."""
+	rights = 0
+	for bit, (color, king_loc, rook_loc) in enumerate(castles):
+		king = board[king_loc[0]][king_loc[1]]
+		rook = board[rook_loc[0]][rook_loc[1]]
+		if king is Piece(color, 'king') and rook is Piece(color, 'rook'):
+			rights |= 1 << bit
+	return rights
+
+
 def under_attack(board, loc, spiece):
-	for file, col in enumerate(board):
-		for rank, piece in enumerate(col):
-			capture = Move(board, (file, rank), loc)
-			if (piece and piece.piece_type != 'king' and
-					capture.is_valid(ignore_check=True)):
-				return True
-	my_color = spiece.color
-	file, rank = loc
-	for file_add in -1, 0, 1:
-		for rank_add in -1, 0, 1:
-			o_file = file + file_add
-			o_rank = rank + rank_add
-			if not -1 < o_file < 8 or not -1 < o_rank < 8:
-				continue
-			o_piece = board[o_file][o_rank]
-			if (o_piece and o_piece.color != my_color and
-					o_piece.piece_type == 'king'):
-				return True
+	"""Check whether loc is attacked by the opponents of spiece."""
+	return board_position(board).is_attacked(square(loc), spiece.side ^ 1)
+
+
+def board_position(board):
+	"""Return a bitboard Position holding the pieces of a board."""
+	if isinstance(board, Board):
+		return board.position
+	return bitboard.Position.from_board(board)
+
+
+def en_passant_square(board, ep_square):
+	"""Return ep_square if a pawn could capture onto it, otherwise None.
+
+	Forgetting squares no pawn can use gives transpositions the same hash
+	and bytes, and matches FENs that write '-' for them."""
+	if ep_square is None:
+		return None
+	file, rank = ep_square
+	if rank == 2:
+		pawn, pawn_rank = Piece('white', 'pawn'), 3
+	else:
+		pawn, pawn_rank = Piece('black', 'pawn'), 4
+	for capture_file in file - 1, file + 1:
+		if 0 <= capture_file < 8 and board[capture_file][pawn_rank] is pawn:
+			return ep_square
+	return None
+
+
+def en_passant_target(board, color):
+	"""Return the square a pawn of this color could capture en passant onto."""
+	ep_square = getattr(board, 'ep_square', None)
+	if ep_square is None or ep_square[1] != (2 if color == 'white' else 5):
+		return None
+	return ep_square
+
+
+def generate_pseudo_legal_moves(board, color):
+	"""Generate the moves of this color that follow the movement rules.
+
+	Moves that leave the mover's own king in check are included."""
+	if not isinstance(board, Board):
+		board = Board(board)
+	position = board.position
+	us = bitboard.COLOR_INDEX[color]
+	them = us ^ 1
+	mine = position.pieces[us]
+	own = position.occupancy[us]
+	enemy = position.occupancy[them]
+	occupied = own | enemy
+	empty = ~occupied & bitboard.ALL
+
+	forward = 8 if us == WHITE else -8
+	start_rank = 1 if us == WHITE else 6
+	last_rank = 7 if us == WHITE else 0
+	ep = en_passant_target(board, color)
+	ep_bit = 1 << square(ep) if ep else 0
+	for sq in squares(mine[PAWN]):
+		source = coords(sq)
+		targets = bitboard.PAWN_ATTACKS[us][sq] & (enemy | ep_bit)
+		one = sq + forward
+		if empty >> one & 1:
+			targets |= 1 << one
+			if sq >> 3 == start_rank and empty >> (one + forward) & 1:
+				targets |= 1 << (one + forward)
+		for dest_sq in squares(targets):
+			dest = coords(dest_sq)
+			if dest_sq >> 3 == last_rank:
+				for promotion in promotions:
+					yield Move(board, source, dest, promotion)
+			else:
+				yield Move(board, source, dest)
+
+	for piece_type in KNIGHT, BISHOP, ROOK, QUEEN, KING:
+		for sq in squares(mine[piece_type]):
+			source = coords(sq)
+			targets = position.attacks_from(sq, us, piece_type,
+							occupied) & ~own
+			for dest_sq in squares(targets):
+				yield Move(board, source, coords(dest_sq))
+
+	rights = board.castling >> (2 * us)
+	if not rights & 3:
+		return
+	king = position.king_square(us)
+	if position.is_attacked(king, them):
+		return
+	for bit, rook_sq, passing, dest in ((1, king + 3, king + 1, king + 2),
+					(2, king - 4, king - 1, king - 2)):
+		if (not rights & bit or not mine[ROOK] >> rook_sq & 1 or
+				bitboard.between(king, rook_sq) & occupied or
+				position.is_attacked(passing, them)):
+			continue
+		yield Move(board, coords(king), coords(dest))
+
+
+def generate_legal_moves(board, color):
+	"""Generate every legal move for this color."""
+	if not isinstance(board, Board):
+		board = Board(board)
+	position = board.position
+	us = bitboard.COLOR_INDEX[color]
+	them = us ^ 1
+	for move in generate_pseudo_legal_moves(board, color):
+		hypo = position.copy()
+		source_sq, dest_sq = square(move.source), square(move.dest)
+		piece_type = move.source_piece.kind
+		if move.dest_piece:
+			hypo.remove(dest_sq, them, move.dest_piece.kind)
+		elif piece_type == PAWN and move.file_dist:
+			hypo.remove(square((move.dest[0], move.source[1])),
+					them, PAWN)
+		hypo.remove(source_sq, us, piece_type)
+		hypo.put(dest_sq, us, piece_type)
+		if not hypo.in_check(us):
+			yield move
+
+
+def has_legal_move(board, color):
+	"""Check whether this color has a legal move, stopping at the first one."""
+	for move in generate_legal_moves(board, color):
+		return True
 	return False
 
 
+def insufficient_material(board):
+	"""Check whether neither side has enough material left to checkmate."""
+	pieces = board_position(board).pieces
+	for mine in pieces:
+		if mine[PAWN] or mine[ROOK] or mine[QUEEN]:
+			return False
+	knights = pieces[WHITE][KNIGHT] | pieces[BLACK][KNIGHT]
+	bishops = pieces[WHITE][BISHOP] | pieces[BLACK][BISHOP]
+	if bitboard.popcount(knights | bishops) <= 1:
+		return True
+	return not knights and (not bishops & bitboard.LIGHT_SQUARES or
+				not bishops & bitboard.DARK_SQUARES)
+
+
+def game_result(board):
+	"""Decide whether the game on this board is over.
+
+	Returns None if the side to move can play on, otherwise a pair of the
+	reason ('checkmate', 'stalemate', 'insufficient material' or
+	'fifty-move rule') and the winning color, or None for a draw."""
+	if not isinstance(board, Board):
+		board = Board(board)
+	color = board.turn
+	if not has_legal_move(board, color):
+		king = board.kings[color]
+		if king is not None and under_attack(board, king, Piece(color, 'king')):
+			return 'checkmate', 'black' if color == 'white' else 'white'
+		return 'stalemate', None
+	if insufficient_material(board):
+		return 'insufficient material', None
+	if board.halfmove >= 100:
+		return 'fifty-move rule', None
+	return None
+
+
 class Move(object):
 	"""A move in a chess game."""
 
-	def __init__(self, board, source, dest):
+	def __init__(self, board, source, dest, promotion=None):
+		if not isinstance(board, Board):
+			board = Board(board)
 		self.board, self.source, self.dest = board, source, dest
+		self.promotion = promotion
 		self.source_piece = board[source[0]][source[1]]
 		self.dest_piece = board[dest[0]][dest[1]]
 		self.file_dist = abs(self.source[0] - self.dest[0])
@@ -104,8 +624,11 @@ class Move(object):
 		alpha = "ABCDEFGH"
 		nums = "87654321"
 		fields = shorthand.split()
-		if len(fields) != 3 or fields[1] != 'to':
+		if len(fields) not in (3, 4) or fields[1] != 'to':
 			raise ValueError("Malformed shorthand: " + shorthand)
+		promotion = fields[3] if len(fields) == 4 else None
+		if promotion is not None and promotion not in promotions:
+			raise ValueError("Invalid promotion: " + promotion)
 		fields = fields[0], fields[2]
 		for field in fields:
 			if (len(field) != 2 or
@@ -114,96 +637,240 @@ class Move(object):
 				raise ValueError("Invalid coordinates: " + field)
 		source = alpha.index(fields[0][0]), nums.index(fields[0][1])
 		dest = alpha.index(fields[1][0]), nums.index(fields[1][1])
-		return cls(board, source, dest)
+		return cls(board, source, dest, promotion)
+
+	@classmethod
+	def from_san(cls, board, san):
+		"""Create the legal move for the side to move named by SAN.
+
+		Raises ValueError if the SAN is malformed, or names no legal move
+		or more than one."""
+		text = san.rstrip('+#!?')
+		if text in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+			kind, dest_file = KING, 6 if len(text) == 3 else 2
+			from_file = from_rank = promotion = None
+			dest_rank = 7 if board.turn == 'white' else 0
+		else:
+			match = san_pattern.match(text)
+			if not match:
+				raise ValueError("Malformed SAN: " + san)
+			symbol, from_file, from_rank, dest, promotion = match.groups()
+			kind = 'PNBRQK'.index(symbol or 'P')
+			from_file = from_file and 'abcdefgh'.index(from_file)
+			from_rank = from_rank and 8 - int(from_rank)
+			dest_file, dest_rank = 'abcdefgh'.index(dest[0]), 8 - int(dest[1])
+			if promotion:
+				promotion = fen_symbols[promotion.lower()]
+		found = None
+		for move in generate_legal_moves(board, board.turn):
+			source_file, source_rank = move.source
+			if (move.source_piece.kind != kind or
+					move.dest != (dest_file, dest_rank) or
+					from_file not in (None, source_file) or
+					from_rank not in (None, source_rank) or
+					(move.promotion or 'queen' if move.is_promotion
+						else None) != (promotion or None)):
+				continue
+			if found is not None:
+				raise ValueError("Ambiguous SAN: " + san)
+			found = move
+		if found is None:
+			raise ValueError("Illegal move: " + san)
+		return found
 
 	def apply(self, silenced=False):
 		"""Modify the board to the state it would be if this move were made."""
 		if not silenced and not self.is_valid():
 			warn('Applying invalid move')
-		if self.source_piece.piece_type in ('pawn', 'rook', 'king'):
-			self.source_piece.moved = True
-		if self.source_piece.piece_type == 'pawn':
-			direction = 1 if self.is_black_move else -1
-			if self.dest[1] == self.source[1] + (direction * 2):
-				self.source_piece.two_space = True
-		self.board[self.source[0]][self.source[1]] = None
-		self.board[self.dest[0]][self.dest[1]] = self.source_piece
+		self.make()
+
+	def make(self):
+		"""Make this move on the board in place.
+
+		Everything the move changes is recorded in self.undo, so that
+		unmake() can restore the board exactly."""
+		board = self.board
+		piece = self.source_piece
+		source_file, source_rank = self.source
+		dest_file, dest_rank = self.dest
 		if self.is_en_passant:
-			dest_file, dest_rank = self.dest
-			self.board[dest_file][dest_rank - direction] = None
-		for col in self.board:
-			for piece in col:
-				if (piece and piece.color != self.source_piece.color and
-						piece.piece_type == 'pawn'):
-					piece.two_space = False
+			captured_loc = dest_file, source_rank
+		else:
+			captured_loc = self.dest
+		captured = board[captured_loc[0]][captured_loc[1]]
+		self.undo = (captured, captured_loc, board.hash, board.mg, board.eg,
+				board.phase) + board.state
+		state_hash = board.state_hash(board.castling, board.ep_square)
+
+		board[source_file][source_rank] = None
+		board.lift(self.source, piece)
+		if captured:
+			board[captured_loc[0]][captured_loc[1]] = None
+			board.lift(captured_loc, captured)
+		if self.is_promotion:
+			placed = Piece(piece.color, self.promotion or 'queen')
+		else:
+			placed = piece
+		board[dest_file][dest_rank] = placed
+		board.drop(self.dest, placed)
+		if self.is_castle:
+			rook_source, rook_dest = self.castle_rook
+			rook = board[rook_source[0]][rook_source[1]]
+			board[rook_source[0]][rook_source[1]] = None
+			board.lift(rook_source, rook)
+			board[rook_dest[0]][rook_dest[1]] = rook
+			board.drop(rook_dest, rook)
+
+		board.castling &= (castle_masks[square(self.source)] &
+				castle_masks[square(self.dest)])
+		if piece.kind == PAWN and self.rank_dist == 2:
+			board.ep_square = en_passant_square(board,
+					(dest_file, (source_rank + dest_rank) // 2))
+		else:
+			board.ep_square = None
+		if piece.kind == PAWN or captured:
+			board.halfmove = 0
+		else:
+			board.halfmove += 1
+		if piece.side == BLACK:
+			board.fullmove += 1
+		turn = 'black' if piece.side == WHITE else 'white'
+		if turn != board.turn:
+			board.turn = turn
+			board.hash ^= bitboard.ZOBRIST_BLACK
+		board.hash ^= state_hash ^ board.state_hash(board.castling,
+							board.ep_square)
+
+	def unmake(self):
+		"""Take back this move after make(), restoring the board exactly."""
+		board = self.board
+		piece = self.source_piece
+		(captured, captured_loc, board.hash, board.mg, board.eg,
+			board.phase, board.turn, board.castling,
+			board.ep_square, board.halfmove, board.fullmove) = self.undo
+		del self.undo
+		position = board.position
+		if self.is_castle:
+			rook_source, rook_dest = self.castle_rook
+			rook = board[rook_dest[0]][rook_dest[1]]
+			board[rook_dest[0]][rook_dest[1]] = None
+			position.remove(square(rook_dest), rook.side, rook.kind)
+			board[rook_source[0]][rook_source[1]] = rook
+			position.put(square(rook_source), rook.side, rook.kind)
+		placed = board[self.dest[0]][self.dest[1]]
+		board[self.dest[0]][self.dest[1]] = None
+		position.remove(square(self.dest), placed.side, placed.kind)
+		if captured:
+			board[captured_loc[0]][captured_loc[1]] = captured
+			position.put(square(captured_loc), captured.side, captured.kind)
+		board[self.source[0]][self.source[1]] = piece
+		position.put(square(self.source), piece.side, piece.kind)
+		if piece.kind == KING:
+			board.kings[piece.color] = self.source
 
 	@property
 	def is_capture(self):
 		return ((bool(self.dest_piece) and
-			self.source_piece.color != self.dest_piece.color) or
+			self.source_piece.side != self.dest_piece.side) or
 			self.is_en_passant)
 
 	@property
 	def is_black_move(self):
-		return self.source_piece.color == 'black'
+		return self.source_piece.side == BLACK
 
 	@property
 	def is_white_move(self):
-		return self.source_piece.color == 'white'
+		return self.source_piece.side == WHITE
+
+	@property
+	def is_promotion(self):
+		"""Check whether this move takes a pawn to the last rank."""
+		return self.source_piece.kind == PAWN and self.dest[1] in (0, 7)
+
+	@property
+	def is_castle(self):
+		"""Check whether this move is a king moving two files to castle."""
+		return (self.source_piece.kind == KING and
+			self.file_dist == 2 and self.rank_dist == 0)
+
+	@property
+	def castle_rook(self):
+		"""Return the source and destination of the rook in a castling move."""
+		source_file, rank = self.source
+		if self.dest[0] > source_file:
+			return (7, rank), (source_file + 1, rank)
+		else:
+			return (0, rank), (source_file - 1, rank)
 
 	@property
 	def is_en_passant(self):
 		"""Check whether this move is an en passant capture."""
-		try:
-			if self.source_piece.piece_type == 'pawn':
-				dest_file, dest_rank = self.dest
-				direction = 1 if self.is_black_move else -1
-				passing_piece = self.board[dest_file][dest_rank - direction]
-				return (bool(passing_piece) and
-					passing_piece.piece_type == 'pawn' and
-					passing_piece.two_space and
-					passing_piece.color != self.source_piece.color)
-		except IndexError:
-			pass
-		return False
+		piece = self.source_piece
+		return (piece.kind == PAWN and self.file_dist == 1 and
+			self.dest == en_passant_target(self.board, piece.color))
 
 	@property
 	def in_check(self):
 		"""Check whether the king of this side is under attack."""
-		for file, col in enumerate(self.board):
-			for rank, piece in enumerate(col):
-				if (piece and piece.piece_type == 'king'
-						and piece.color == self.source_piece.color):
-					return under_attack(self.board,
-								(file, rank), piece)
-		return False
+		color = self.source_piece.color
+		board = self.board
+		key = board.hash, color
+		result = rule_cache.get(key)
+		if result is None:
+			king_loc = board.kings[color]
+			result = (king_loc is not None and
+				under_attack(board, king_loc, self.source_piece))
+			rule_cache.put(key, result)
+		return result
 
 	@property
 	def into_check(self):
 		"""Check whether this move describes a move into check."""
-		hypo_board = [col[:] for col in self.board]
-		hypo_move = Move(hypo_board, self.source, self.dest)
-		hypo_move.apply(silenced=True)
-		return under_attack(hypo_board, self.dest, self.source_piece)
+		self.make()
+		try:
+			return under_attack(self.board, self.dest, self.source_piece)
+		finally:
+			self.unmake()
 
 	@property
 	def resolves_check(self):
-		"""Check whether this move will cause the king of this side to no longer be in check."""
-		hypo_board = [col[:] for col in self.board]
-		hypo_move = Move(hypo_board, self.source, self.dest)
-		hypo_move.apply(silenced=True)
-		return not hypo_move.in_check
+		"""Check whether the king of this side is safe once this move is made."""
+		self.make()
+		try:
+			return not self.in_check
+		finally:
+			self.unmake()
 
 	def is_valid(self, ignore_check=False):
 		"""Check whether this move is valid according to the rules of chess.
 
-		This property does NOT account for check lockdown!"""
-		if not ignore_check and self.in_check and not self.resolves_check:
+		Unless ignore_check is set, moves that leave the king of this
+		side in check are invalid.  Results are shared through rule_cache,
+		keyed by the board's position hash."""
+		key = self.board.hash, self.source, self.dest, bool(ignore_check)
+		result = rule_cache.get(key)
+		if result is None:
+			result = self._is_valid(ignore_check)
+			rule_cache.put(key, result)
+		return result
+
+	def is_legal(self):
+		"""Check whether this move may be played now.
+
+		A piece of the side to move must stand on the source square, and
+		the move must be valid."""
+		piece = self.source_piece
+		return (piece is not None and piece.color == self.board.turn and
+			self.is_valid())
+
+	def _is_valid(self, ignore_check):
+		if self.source_piece is None:
 			return False
-		delegate_response = getattr(self,
-					'is_valid_' + self.source_piece.piece_type)
+		delegate_response = self.validators[self.source_piece.kind].fget(self)
 		into_self = bool(self.dest_piece) and not self.is_capture
-		return delegate_response and not into_self
+		if not delegate_response or into_self:
+			return False
+		return ignore_check or self.resolves_check
 
 	@property
 	def is_valid_pawn(self):
@@ -217,7 +884,7 @@ class Move(object):
 			return one_forward and diagonal_move
 		else:
 			straight_move = dest_file == source_file
-			first_move = not self.source_piece.moved
+			first_move = source_rank == (1 if self.is_black_move else 6)
 			double_move = dest_rank == source_rank + (direction * 2)
 			nothing_blocking = not self.board[source_file][source_rank + direction]
 			correct_forward = one_forward or (first_move and
@@ -232,10 +899,31 @@ class Move(object):
 	@property
 	def is_valid_king(self):
 		"""Check whether this move is valid, assuming the source piece is a king."""
+		if self.is_castle:
+			return self.is_valid_castle
 		return (self.file_dist in (0, 1) and
 			self.rank_dist in (0, 1) and not
 			self.into_check)
 
+	@property
+	def is_valid_castle(self):
+		"""Check whether this move is valid, assuming it is a castling move."""
+		king = self.source_piece
+		source_file, rank = self.source
+		(rook_file, _), (passing_file, _) = self.castle_rook
+		bit = 1 << (2 * king.side + (rook_file == 0))
+		if (not self.board.castling & bit or self.dest_piece or
+				self.source != (4, 7 if king.side == WHITE else 0) or
+				self.board[rook_file][rank] is not Piece(king.color, 'rook')):
+			return False
+		for file in irange(source_file, rook_file):
+			if self.board[file][rank]:
+				return False
+		for file in source_file, passing_file:
+			if under_attack(self.board, (file, rank), king):
+				return False
+		return not self.into_check
+
 	@property
 	def is_valid_rook(self):
 		"""Check whether this move is valid, assuming the source piece is a rook."""
@@ -268,6 +956,9 @@ class Move(object):
 		"""Check whether this move is valid, assuming the source piece is a queen."""
 		return self.is_valid_rook or self.is_valid_bishop
 
+	validators = (is_valid_pawn, is_valid_knight, is_valid_bishop,
+		is_valid_rook, is_valid_queen, is_valid_king)
+
 	@property
 	def shorthand(self):
 		"""Convert this move to a string suitable for text-based communication."""
@@ -277,10 +968,14 @@ class Move(object):
 		source_coords = alpha[source_file] + nums[source_rank]
 		dest_file, dest_rank = self.dest
 		dest_coords = alpha[dest_file] + nums[dest_rank]
-		return "{} to {}".format(source_coords, dest_coords)
+		shorthand = "{} to {}".format(source_coords, dest_coords)
+		if self.promotion not in (None, 'queen'):
+			shorthand += " " + self.promotion
+		return shorthand
 
 	def __repr__(self):
 		alpha = "ABCDEFGH"
+		nums = "87654321"
 		source_piece = repr(self.source_piece)
 		source_file, source_rank = self.source
 		source_coords = alpha[source_file] + nums[source_rank]
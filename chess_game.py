@@ -2,10 +2,14 @@
 from __future__ import print_function
 import pygame
 import chess
+import engine
 import gridgame
+import protocol
 import socket
 import argparse
 import sys
+import threading
+import time
 
 b = gridgame.RGB(0, 0, 0)
 w = gridgame.RGB(255, 255, 255)
@@ -21,36 +25,88 @@ bg_grid = [
 	[w, b, w, b, w, b, w, b],
 	[b, w, b, w, b, w, b, w]]
 
+# Custom pygame events: a message from the other side, and a heartbeat.
+NETWORK = pygame.USEREVENT
+HEARTBEAT = pygame.USEREVENT + 1
+HEARTBEAT_MS = 10000
+# Seconds without a word from the other side, pings and all, before it
+# is taken to be gone.
+SILENCE_LIMIT = 30.0
+
 parser = argparse.ArgumentParser(description="A chess game.")
 parser.add_argument('-p', '--port', type=int, default=2009,
 		help="The port to host on or connect to.")
 parser.add_argument('-c', '--connect', metavar="hostname",
 		help="Connect to a host.")
+parser.add_argument('-w', '--watch', type=int, metavar="game",
+		help="Watch a game on the server instead of playing (0 for the newest).")
 parser.add_argument('-o', '--hotseat', action='store_true')
 parser.add_argument('-l', '--log', action='store_true')
+parser.add_argument('-e', '--vs-engine', action='store_true',
+		help="Play white against the computer.")
+parser.add_argument('-t', '--engine-time', type=float, default=2.0,
+		help="Seconds the computer may think per move.")
+
+
+def load_piece_texture(color, piece_type):
+	"""Load the texture for a chess piece."""
+	texture_path = "chess_textures/{}{}.png".format(color[0], piece_type)
+	return gridgame.Texture(texture_path).surface
+
+
+chess.Piece.texture_loader = load_piece_texture
 
 
 def beep():
 	print('\a', file=sys.stderr)
 
 
+def receive_messages(channel):
+	"""Post each message from a channel to the pygame event queue.
+
+	This runs in its own thread, so the game keeps drawing and handling
+	input while it waits.  A message of None is posted when the
+	connection ends."""
+	while True:
+		try:
+			msg = channel.receive()
+		except (ConnectionError, protocol.ProtocolError, OSError, ValueError):
+			msg = None
+		try:
+			pygame.event.post(pygame.event.Event(NETWORK, message=msg))
+		except pygame.error:
+			return
+		if msg is None:
+			return
+
+
 class ChessGame:
 	"""Represents a game state."""
-	def __init__(self, color='white', sock=None, hotseat=False, log=False):
+	def __init__(self, color='white', channel=None, hotseat=False, log=False,
+			engine_time=None, spectating=False):
 		self.color = color
-		self.my_turn = color == 'white'
-		self.sock = sock
+		self.spectating = spectating
+		self.my_turn = color == 'white' and not spectating
+		self.channel = channel
+		self.draw_offered = self.draw_proposed = False
+		self.unconfirmed = {}
 		self.hotseat = hotseat
 		self.log = log
+		self.engine_time = engine_time
+		self.result = None
 
 		world = gridgame.World()
 		world.unit_x, world.unit_y = 64, 64
-		world.add_obj(gridgame.GridEntity(bg_grid))
+		world.add_obj(gridgame.GridEntity(bg_grid, static=True))
 		self.world = world
 
 		board = chess.new_board()
-		world.add_obj(gridgame.GridEntity(board))
+		board_entity = gridgame.GridEntity(board)
+		world.add_obj(board_entity)
 		self.board = board
+		self.board_entity = board_entity
+		self.shown = None
+		self.shown_color = None
 
 		piece_selector_texture = gridgame.Texture("chess_textures/select_piece.png")
 		move_selector_texture = gridgame.Texture("chess_textures/select_move.png")
@@ -66,6 +122,9 @@ class ChessGame:
 		bus = gridgame.SimpleEventBus()
 		bus.add_listener(self.on_key, pygame.KEYDOWN)
 		bus.add_listener(lambda e: exit(), pygame.QUIT)
+		bus.add_listener(lambda e: self.world.redraw_all(), pygame.VIDEOEXPOSE)
+		bus.add_listener(self.on_network, NETWORK)
+		bus.add_listener(self.on_heartbeat, HEARTBEAT)
 		self.bus = bus
 
 	def play(self):
@@ -76,45 +135,82 @@ class ChessGame:
 
 		self.world.surf = scr
 
+		if self.channel:
+			receiver = threading.Thread(target=receive_messages,
+					args=(self.channel,))
+			receiver.daemon = True
+			receiver.start()
+			pygame.time.set_timer(HEARTBEAT, HEARTBEAT_MS)
+
 		changed = True
-		while True:
-			if self.color == 'black':
-				self.rotate_board()
-				self.world.draw()
-				self.rotate_board()
-			else:
-				self.world.draw()
-			if self.my_turn:
-				self.bus.pump_one(pygame.event.wait())
+		while self.result is None:
+			if changed:
+				self.draw()
+			if self.my_turn or self.channel:
+				changed = self.bus.pump_one(pygame.event.wait())
 			else:
 				self.serve()
+				changed = True
+		self.draw()
+		self.end_game()
+
+	def draw(self):
+		"""Draw the board from this player's side."""
+		if self.color != self.shown_color:
+			self.world.set_rotation(180 if self.color == 'black' else 0)
+			self.shown_color = self.color
+		self.mark_changed_squares()
+		self.world.draw()
+
+	def mark_changed_squares(self):
+		"""Mark the squares changed since the last draw for redrawing.
+
+		Moves write to the board directly rather than through its grid
+		entity, so the board is compared with the pieces last shown."""
+		shown = self.shown
+		if shown is not None:
+			self.board_entity.invalidate((x, y)
+				for x, col in enumerate(self.board)
+				for y, piece in enumerate(col)
+				if piece is not shown[x][y])
+		self.shown = [list(col) for col in self.board]
 
 	@property
 	def checkmated(self):
-		#TODO: Implement a method to check if this player is in checkmate
-		pass
+		"""Check whether this player is in checkmate."""
+		return (self.result is not None and self.result[0] == 'checkmate' and
+			self.result[1] != self.color)
 
-	def rotate_board(self):
-		"""Rotate the board 180 degrees."""
-		for col in self.board:
-			col.reverse()
-		self.board.reverse()
-		#self.board._grid = list(zip(self.board._grid[::-1]))
-		#self.board._grid = list(zip(self.board._grid[::-1]))
+	def update_result(self):
+		"""Check whether the last move ended the game."""
+		self.result = chess.game_result(self.board)
+
+	def end_game(self):
+		"""Report the result and release the connection."""
+		reason, winner = self.result
+		if reason == 'closed':
+			print("The broadcast has ended.")
+		elif winner is None:
+			print("Draw by {}.".format(reason))
+		else:
+			print("{} wins by {}.".format(winner.capitalize(), reason))
+		if self.channel:
+			self.channel.close()
 
 	def on_key(self, event):
 		"""Handle a keypress event."""
+		if self.spectating:
+			return
 		active_selector = self.active_selector
 		piece_selector = self.piece_selector
 		move_selector = self.move_selector
 		if event.key in gridgame.DIRECTION:
 			self.update_selector(event.key)
+		elif event.key == pygame.K_RETURN and not self.my_turn:
+			beep()
 		elif event.key == pygame.K_RETURN:
 			if active_selector is piece_selector:
-				if self.color == 'white':
-					selection = self.board[piece_selector.x][piece_selector.y]
-				else:
-					selection = self.board[7 - piece_selector.x][7 - piece_selector.y]
+				selection = self.board[piece_selector.x][piece_selector.y]
 				if selection and selection.color == self.color:
 					move_selector.coords = piece_selector.coords
 					self.active_selector = move_selector
@@ -133,12 +229,22 @@ class ChessGame:
 			if active_selector is move_selector:
 				move_selector.coords = -1, -1
 				self.active_selector = piece_selector
+		elif event.key == pygame.K_r and self.channel:
+			self.send(protocol.RESIGN)
+			self.result = 'resignation', self.opponent
+		elif event.key == pygame.K_d and self.channel:
+			self.send(protocol.DRAW)
+			if self.draw_offered:
+				self.result = 'agreement', None
+			else:
+				self.draw_proposed = True
+				print("Draw offered.")
 
 	def update_selector(self, direction):
 		"""Move a selector in the given direction, respecting board bounds."""
 		mod = gridgame.DIRECTION[direction]
 		selector = self.active_selector
-		new_coords = mod(selector.coords)
+		new_coords = self.world.view_step(selector.coords, mod)
 		if 0 <= new_coords[0] < 8 and 0 <= new_coords[1] < 8:
 			selector.coords = new_coords
 		else:
@@ -146,48 +252,162 @@ class ChessGame:
 
 	def try_move(self, source, dest):
 		"""Attempt to execute a move and validate it with the other player."""
-		if self.color == 'black':
-			source = 7 - source[0], 7 - source[1]
-			dest = 7 - dest[0], 7 - dest[1]
 		move = chess.Move(self.board, source, dest)
 		if move.is_valid() and self.confirm(move):
 			move.apply()
+			self.draw_offered = self.draw_proposed = False
+			self.update_result()
 			return True
 		return False
 
 	def confirm(self, move):
-		"""Confirm the validity of this move with the other game instance."""
-		if self.hotseat:
+		"""Send this move to the other game instance.
+
+		Networked moves are made at once and taken back if the other side
+		rejects them, so the game never waits on the network."""
+		if self.hotseat or self.engine_time is not None:
 			if self.log:
 				print(move.shorthand)
 			return True
-		self.sock.send(move.shorthand.encode('UTF-8') + b'\r\n')
-		valid = self.sock.recv(100).strip().decode() == 'OK'
-		if valid and self.log:
-			print(move.shorthand)
-		return valid
+		try:
+			number = self.channel.send_move(move.shorthand)
+		except OSError:
+			self.connection_lost()
+			return False
+		self.unconfirmed[number] = move
+		return True
 
 	def serve(self):
-		"""Wait for the other game instance to make a move, then validate it."""
+		"""Let the other player of a hotseat or computer game move."""
 		if self.hotseat:
 			self.my_turn = True
 			self.color = 'black' if self.color == 'white' else 'white'
 			return
-		got_move = False
-		while not got_move:
-			shorthand = self.sock.recv(100).strip().decode()
+		if self.engine_time is not None:
+			self.play_engine_move()
+			return
+
+	@property
+	def opponent(self):
+		return 'black' if self.color == 'white' else 'white'
+
+	def on_network(self, event):
+		"""Handle a message posted by the receiver thread."""
+		if event.message is None:
+			self.connection_lost()
+			return
+		self.handle_message(event.message)
+
+	def connection_lost(self):
+		"""End the game once the other side can no longer be reached."""
+		if self.result is None:
+			if self.spectating:
+				self.result = 'closed', None
+			else:
+				self.result = 'abandonment', self.color
+
+	def send(self, kind, number=None, text=None):
+		"""Send a message, ending the game if the connection has gone."""
+		try:
+			self.channel.send(kind, number, text)
+		except OSError:
+			self.connection_lost()
+
+	def on_heartbeat(self, event):
+		"""Ping the other side, or give up on it if it has gone quiet."""
+		if self.channel.closed:
+			return
+		if time.monotonic() - self.channel.last_received > SILENCE_LIMIT:
+			self.connection_lost()
+			return
+		self.send(protocol.PING, self.channel.next_number)
+
+	def handle_message(self, msg):
+		"""Act on a message from the other side."""
+		if self.spectating:
+			self.watch_message(msg)
+		elif msg.kind == protocol.ACK:
+			move = self.unconfirmed.pop(msg.number, None)
+			if move is not None and self.log:
+				print(move.shorthand)
+		elif msg.kind == protocol.NAK:
+			move = self.unconfirmed.pop(msg.number, None)
+			if move is not None:
+				move.unmake()
+				self.update_result()
+				self.my_turn = self.board.turn == self.color
+				beep()
+		elif msg.kind == protocol.MOVE:
 			try:
-				move = chess.Move.from_shorthand(self.board, shorthand)
-				got_move = move.is_valid()
-			except ValueError as e:
-				pass
-			if got_move:
-				self.sock.send(b'OK\r\n')
-				if self.log:
-					print(shorthand)
+				move = chess.Move.from_shorthand(self.board, msg.text)
+				valid = not self.my_turn and move.is_legal()
+			except ValueError:
+				valid = False
+			if not valid:
+				self.send(protocol.NAK, msg.number, "illegal")
+				return
+			self.send(protocol.ACK, msg.number)
+			if self.log:
+				print(msg.text)
+			move.apply()
+			self.draw_offered = self.draw_proposed = False
+			self.update_result()
+			self.my_turn = True
+		elif msg.kind == protocol.SYNC:
+			# Moves still awaiting an answer were made on the old position,
+			# so they can no longer be taken back.
+			self.unconfirmed.clear()
+			self.board.set_fen(msg.text)
+			self.my_turn = self.board.turn == self.color
+			self.update_result()
+		elif msg.kind == protocol.RESIGN:
+			self.result = 'resignation', self.color
+		elif msg.kind == protocol.DRAW:
+			if self.draw_proposed:
+				self.result = 'agreement', None
 			else:
-				self.sock.send(b'NO\r\n')
+				self.draw_offered = True
+				print("Your opponent offers a draw; press D to accept.")
+		elif msg.kind == protocol.RESULT:
+			self.take_result(msg.text)
+
+	def watch_message(self, msg):
+		"""Follow a broadcast game: a snapshot, then each move."""
+		if msg.kind == protocol.MOVE:
+			move = chess.Move.from_shorthand(self.board, msg.text)
+			if self.log:
+				print(msg.text)
+			move.apply(silenced=True)
+			self.update_result()
+		elif msg.kind == protocol.SYNC:
+			self.board.set_fen(msg.text)
+			self.update_result()
+		elif msg.kind == protocol.RESIGN:
+			self.result = ('resignation',
+				'black' if msg.text == 'white' else 'white')
+		elif msg.kind == protocol.DRAW:
+			self.result = 'agreement', None
+		elif msg.kind == protocol.RESULT:
+			self.take_result(msg.text)
+
+	def take_result(self, text):
+		"""Adopt the result the server sent, unless the game is already over."""
+		if self.result is None:
+			try:
+				self.result = protocol.parse_result(text)
+			except protocol.ProtocolError:
+				pass
+
+	def play_engine_move(self):
+		"""Let the computer choose and make a move within its time budget."""
+		move, search = engine.search(self.board, self.engine_time)
+		print("Engine: depth {}, {} nodes in {:.2f}s, {:.0f} nodes/s".format(
+			search.depth, search.nodes, search.elapsed, search.nps),
+			file=sys.stderr)
+		if self.log:
+			print(move.shorthand)
 		move.apply()
+		self.update_result()
 		pygame.event.get()
 		self.my_turn = True
 
@@ -197,6 +417,23 @@ def run_game(opts):
 	if opts.hotseat:
 		ChessGame(hotseat=True, log=opts.log).play()
 		return
+	if opts.vs_engine:
+		ChessGame(log=opts.log, engine_time=opts.engine_time).play()
+		return
+	if opts.watch is not None:
+		sock = socket.create_connection((opts.connect or 'localhost',
+				opts.port))
+		channel = protocol.Channel(sock)
+		channel.hello('spectator')
+		channel.send(protocol.WATCH, opts.watch)
+		try:
+			channel.expect_hello()
+		except protocol.ProtocolError:
+			print("No such game.")
+			channel.close()
+			return
+		ChessGame(channel=channel, log=opts.log, spectating=True).play()
+		return
 	if not opts.connect:
 		color = 'white'
 		ssock = socket.socket()
@@ -204,12 +441,18 @@ def run_game(opts):
 		ssock.listen(1)
 		print("Awaiting connection...")
 		sock, _ = ssock.accept()
+		channel = protocol.Channel(sock)
+		channel.hello('black')
+		channel.expect_hello()
 	else:
-		color = 'black'
 		sock = socket.socket()
 		sock.connect((opts.connect, opts.port))
+		channel = protocol.Channel(sock)
+		channel.hello()
+		print("Waiting for an opponent...")
+		color = channel.expect_hello() or 'black'
 	print("Connection established! Starting game...")
-	ChessGame(color, sock, log=opts.log).play()
+	ChessGame(color, channel, log=opts.log).play()
 
 def main_cli():
 	"""Get options from the command-line flags, then run the game."""
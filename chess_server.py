@@ -0,0 +1,389 @@
+#!/usr/bin/python3
+"""Host many networked chess games from one process.
+
+Clients connect to a single port, introduce themselves with HELLO and
+are paired in the order they arrive.  Each is then sent HELLO with the
+color it plays, and the game runs with the messages in protocol.py.
+The server checks every move against the rules before passing it on,
+and sends SYNC with the true position to a client that rejects one.
+
+Spectators are sent the position and then each move.  Every spectator
+has its own bounded queue and writer, so a slow one never delays the
+players; one that falls too far behind skips ahead to a new snapshot.
+"""
+from __future__ import print_function
+import chess
+import protocol
+import argparse
+import asyncio
+import sys
+
+BACKLOG = 1024
+OBSERVER_QUEUE = 64
+
+parser = argparse.ArgumentParser(description="Host chess games.")
+parser.add_argument('-p', '--port', type=int, default=2009,
+		help="The port to listen on.")
+parser.add_argument('-t', '--timeout', type=float, default=300.0,
+		help="Seconds a player may take over a move.")
+parser.add_argument('-m', '--max-clients', type=int, default=10000,
+		help="The most connections to accept at once.")
+
+
+class Disconnected(Exception):
+	"""Raised when a client closes its connection, times out or misbehaves."""
+
+	def __init__(self, client):
+		Exception.__init__(self, client.name)
+		self.client = client
+
+
+class Client(object):
+	"""One connected player."""
+
+	def __init__(self, reader, writer, timeout):
+		self.reader = reader
+		self.writer = writer
+		self.timeout = timeout
+		self.name = '{}:{}'.format(*writer.get_extra_info('peername')[:2])
+		self.next_number = 1
+		self.lobby_watch = None
+		self.finished = asyncio.Event()
+
+	async def read_message(self, timeout=None):
+		"""Return the next message.
+
+		Raises Disconnected if the client hangs up, breaks the protocol or
+		says nothing within the timeout."""
+		try:
+			line = await asyncio.wait_for(self.reader.readline(), timeout)
+		except (asyncio.TimeoutError, ValueError, ConnectionError):
+			raise Disconnected(self)
+		if not line.endswith(b'\n'):
+			raise Disconnected(self)
+		try:
+			return protocol.decode(line)
+		except protocol.ProtocolError:
+			raise Disconnected(self)
+
+	async def send(self, kind, number=None, text=None):
+		"""Send a message, waiting while the client's buffer is full."""
+		try:
+			self.writer.write(protocol.encode(
+				protocol.message(kind, number, text)))
+			await asyncio.wait_for(self.writer.drain(), self.timeout)
+		except (asyncio.TimeoutError, ConnectionError):
+			raise Disconnected(self)
+
+	async def send_move(self, shorthand):
+		number = self.next_number
+		self.next_number += 1
+		await self.send(protocol.MOVE, number, shorthand)
+		return number
+
+	def close(self):
+		self.writer.close()
+
+
+class Observer(object):
+	"""A spectator of one game."""
+
+	def __init__(self, client, session):
+		self.client = client
+		self.session = session
+		self.queue = asyncio.Queue(OBSERVER_QUEUE)
+
+	def post(self, data):
+		"""Queue encoded messages to send, or None to finish, without waiting.
+
+		If the queue is full, the spectator is sent the current position in
+		place of everything it has not yet been sent."""
+		try:
+			self.queue.put_nowait(data)
+		except asyncio.QueueFull:
+			while not self.queue.empty():
+				self.queue.get_nowait()
+			self.queue.put_nowait(self.session.snapshot())
+			if data is None:
+				self.queue.put_nowait(None)
+
+	async def run(self):
+		"""Send queued messages until the game ends or the spectator leaves."""
+		client = self.client
+		reading = asyncio.ensure_future(self.read())
+		try:
+			while True:
+				data = await self.queue.get()
+				if data is None:
+					break
+				client.writer.write(data)
+				await asyncio.wait_for(client.writer.drain(), client.timeout)
+		except (asyncio.TimeoutError, ConnectionError):
+			pass
+		finally:
+			reading.cancel()
+
+	async def read(self):
+		"""Answer pings, and stop sending when the spectator hangs up."""
+		try:
+			while True:
+				msg = await self.client.read_message()
+				if msg.kind == protocol.PING:
+					self.post(protocol.encode(protocol.message(
+						protocol.PONG, msg.number)))
+		except Disconnected:
+			self.post(None)
+
+
+class GameSession(object):
+	"""A game between two clients, refereed by the server.
+
+	Both clients are read at once, so either may resign, offer a draw or
+	ping at any time.  The player to move must move within the timeout."""
+
+	def __init__(self, number, white, black, timeout):
+		self.number = number
+		self.players = {'white': white, 'black': black}
+		self.timeout = timeout
+		self.board = chess.new_board()
+		self.result = None
+		self.draw_offer = None
+		self.forwarded = {}
+		self.observers = set()
+		self.ply = 0
+
+	@staticmethod
+	def opponent(color):
+		return 'black' if color == 'white' else 'white'
+
+	def snapshot(self):
+		"""Return the encoded SYNC message for the current position."""
+		return protocol.encode(protocol.message(protocol.SYNC,
+			text=chess.board_to_fen(self.board)))
+
+	def broadcast(self, kind, number=None, text=None):
+		"""Send a message to every spectator, encoding it only once."""
+		if self.observers:
+			data = protocol.encode(protocol.message(kind, number, text))
+			for observer in self.observers:
+				observer.post(data)
+
+	async def run(self):
+		"""Play the game until it ends or a player drops out."""
+		loop = asyncio.get_event_loop()
+		messages = asyncio.Queue()
+		readers = [asyncio.ensure_future(self.read_from(color, messages))
+			for color in self.players]
+		try:
+			for color, client in self.players.items():
+				await client.send(protocol.HELLO, protocol.VERSION, color)
+			turn = self.board.turn
+			deadline = loop.time() + self.timeout
+			while self.result is None:
+				try:
+					color, msg = await asyncio.wait_for(messages.get(),
+							deadline - loop.time())
+				except asyncio.TimeoutError:
+					self.result = 'time', self.opponent(self.board.turn)
+					break
+				if msg is None:
+					self.result = 'abandonment', self.opponent(color)
+					break
+				await self.handle(color, msg)
+				if self.board.turn != turn:
+					turn = self.board.turn
+					deadline = loop.time() + self.timeout
+		except Disconnected as e:
+			if self.result is None:
+				self.result = 'abandonment', None
+				for color, client in self.players.items():
+					if client is e.client:
+						self.result = 'abandonment', self.opponent(color)
+		finally:
+			for reader in readers:
+				reader.cancel()
+			if self.result is not None:
+				await self.announce()
+			for client in self.players.values():
+				client.close()
+			for observer in self.observers:
+				observer.post(None)
+		return self.result
+
+	async def announce(self):
+		"""Send the result to everyone still connected.
+
+		Players who lose on time or to a hang-up would otherwise see only
+		the connection close."""
+		text = protocol.result_text(self.result)
+		self.broadcast(protocol.RESULT, text=text)
+		await asyncio.gather(*[client.send(protocol.RESULT, text=text)
+			for client in self.players.values()], return_exceptions=True)
+
+	async def read_from(self, color, messages):
+		"""Queue each message from a player, then None when it leaves."""
+		client = self.players[color]
+		try:
+			while True:
+				messages.put_nowait((color, await client.read_message()))
+		except Disconnected:
+			messages.put_nowait((color, None))
+
+	async def handle(self, color, msg):
+		client = self.players[color]
+		other = self.players[self.opponent(color)]
+		if msg.kind == protocol.MOVE:
+			reason = self.make_move(color, msg.text)
+			if reason:
+				await client.send(protocol.NAK, msg.number, reason)
+				return
+			await client.send(protocol.ACK, msg.number)
+			self.ply += 1
+			self.broadcast(protocol.MOVE, self.ply, msg.text)
+			number = await other.send_move(msg.text)
+			self.forwarded[self.opponent(color)] = number
+			self.draw_offer = None
+			self.result = chess.game_result(self.board)
+		elif msg.kind == protocol.NAK:
+			if self.forwarded.get(color) == msg.number:
+				await client.send(protocol.SYNC,
+					text=chess.board_to_fen(self.board))
+		elif msg.kind == protocol.PING:
+			await client.send(protocol.PONG, msg.number)
+		elif msg.kind == protocol.RESIGN:
+			self.result = 'resignation', self.opponent(color)
+			self.broadcast(protocol.RESIGN, text=color)
+			await other.send(protocol.RESIGN)
+		elif msg.kind == protocol.DRAW:
+			await other.send(protocol.DRAW)
+			if self.draw_offer == self.opponent(color):
+				self.result = 'agreement', None
+				self.broadcast(protocol.DRAW)
+			else:
+				self.draw_offer = color
+
+	def make_move(self, color, shorthand):
+		"""Make a player's move, or return why it cannot be made."""
+		if color != self.board.turn:
+			return "not your turn"
+		try:
+			move = chess.Move.from_shorthand(self.board, shorthand)
+		except ValueError:
+			return "malformed"
+		if not move.is_legal():
+			return "illegal"
+		move.make()
+		return None
+
+
+class ChessServer(object):
+	"""Accept clients on one port and pair them into games."""
+
+	def __init__(self, port=2009, timeout=300.0, max_clients=10000):
+		self.port = port
+		self.timeout = timeout
+		self.slots = asyncio.Semaphore(max_clients)
+		self.waiting = None
+		self.games = {}
+		self.game_count = 0
+
+	async def handle_client(self, reader, writer):
+		if self.slots.locked():
+			writer.close()
+			return
+		async with self.slots:
+			client = Client(reader, writer, self.timeout)
+			try:
+				hello = await client.read_message(self.timeout)
+				if hello.kind != protocol.HELLO:
+					raise Disconnected(client)
+				if hello.number != protocol.VERSION:
+					await client.send(protocol.NAK, 0, "unsupported version")
+					raise Disconnected(client)
+				if hello.text == 'spectator':
+					await self.spectate(client)
+					return
+			except Disconnected:
+				client.close()
+				return
+			while True:
+				white = self.waiting
+				if white is None:
+					await self.wait_for_opponent(client)
+					return
+				self.waiting = None
+				white.lobby_watch.cancel()
+				await asyncio.wait([white.lobby_watch])
+				if white.lobby_watch.cancelled():
+					break
+			self.game_count += 1
+			session = GameSession(self.game_count, white, client, self.timeout)
+			self.games[session.number] = session
+			try:
+				result = await session.run()
+			finally:
+				del self.games[session.number]
+				white.finished.set()
+			print("Game {} ({} v {}): {}".format(session.number, white.name,
+				client.name, ' '.join(str(part) for part in result)),
+				file=sys.stderr)
+
+	async def spectate(self, client):
+		"""Stream a game to a spectator, starting from its position."""
+		watch = await client.read_message(self.timeout)
+		if watch.kind != protocol.WATCH:
+			raise Disconnected(client)
+		if watch.number == 0 and self.games:
+			session = self.games[max(self.games)]
+		else:
+			session = self.games.get(watch.number)
+		if session is None:
+			await client.send(protocol.NAK, watch.number, "no such game")
+			raise Disconnected(client)
+		await client.send(protocol.HELLO, protocol.VERSION)
+		observer = Observer(client, session)
+		observer.post(session.snapshot())
+		session.observers.add(observer)
+		try:
+			await observer.run()
+		finally:
+			session.observers.discard(observer)
+			client.close()
+
+	async def wait_for_opponent(self, client):
+		"""Hold a client in the lobby until another one arrives.
+
+		Clients send nothing between their HELLO and the server's, so
+		reading here only notices a client that hangs up while it waits.
+		The watch is cancelled once the client is paired, and the game is
+		run by the handler of the client that arrived second."""
+		self.waiting = client
+		client.lobby_watch = asyncio.ensure_future(client.reader.read(1))
+		await asyncio.wait([client.lobby_watch])
+		if client.lobby_watch.cancelled():
+			await client.finished.wait()
+			return
+		if self.waiting is client:
+			self.waiting = None
+		client.close()
+
+	async def serve(self):
+		server = await asyncio.start_server(self.handle_client, '0.0.0.0',
+				self.port, limit=protocol.MAX_MESSAGE, backlog=BACKLOG)
+		print("Listening on port {}".format(self.port), file=sys.stderr)
+		async with server:
+			await server.serve_forever()
+
+
+def main_cli():
+	"""Get options from the command-line flags, then run the server."""
+	opts = parser.parse_args()
+	server = ChessServer(opts.port, opts.timeout, opts.max_clients)
+	try:
+		asyncio.run(server.serve())
+	except KeyboardInterrupt:
+		pass
+
+
+if __name__ == '__main__':
+	main_cli()
@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+"""A computer opponent: iterative-deepening alpha-beta search over chess.Board."""
+import chess
+import bitboard
+from evaluation import evaluate
+import time
+
+piece_values = [100, 320, 330, 500, 900, 0]
+MATE = 100000
+INFINITY = 1000000
+CHECK_EVERY = 256
+
+
+class SearchTimeout(Exception):
+	"""Raised inside a search when its time budget has run out."""
+
+
+def is_tactical(move):
+	"""Check whether a move is a capture or a promotion."""
+	return bool(move.dest_piece) or move.is_en_passant or move.is_promotion
+
+
+class Search(object):
+	"""An alpha-beta search with iterative deepening and a time budget.
+
+	Captures are searched first, most valuable victim first, followed by
+	killer moves.  Leaves are extended with a quiescence search over
+	captures.  After a search, nodes, depth and elapsed describe the work
+	done."""
+
+	def __init__(self, board, time_budget=1.0, max_depth=64):
+		self.board = board
+		self.time_budget = time_budget
+		self.max_depth = max_depth
+		self.nodes = 0
+		self.depth = 0
+		self.elapsed = 0.0
+		self.score = 0
+		self.killers = []
+		self.history = []
+
+	@property
+	def nps(self):
+		return self.nodes / self.elapsed if self.elapsed else 0.0
+
+	def run(self, report=None):
+		"""Search until the time budget or maximum depth is reached.
+
+		Returns the best move found, or None if there are no legal moves.
+		If report is given, it is called after each completed depth."""
+		board = self.board
+		self.started = time.time()
+		self.deadline = self.started + self.time_budget
+		root_moves = list(chess.generate_legal_moves(board, board.turn))
+		if not root_moves:
+			return None
+		best = root_moves[0]
+		try:
+			for depth in range(1, self.max_depth + 1):
+				self.killers = [[None, None] for _ in range(depth + 1)]
+				score, move = self.search_root(root_moves, depth, best)
+				best, self.score, self.depth = move, score, depth
+				self.elapsed = time.time() - self.started
+				if report is not None:
+					report(self)
+				if abs(score) >= MATE - self.max_depth:
+					break
+		except SearchTimeout:
+			pass
+		self.elapsed = time.time() - self.started
+		return best
+
+	def search_root(self, moves, depth, previous_best):
+		moves.sort(key=self.order_key(0), reverse=True)
+		moves.remove(previous_best)
+		moves.insert(0, previous_best)
+		alpha, best = -INFINITY, moves[0]
+		for move in moves:
+			move.make()
+			try:
+				score = -self.alpha_beta(depth - 1, 1, -INFINITY, -alpha)
+			finally:
+				move.unmake()
+			if score > alpha:
+				alpha, best = score, move
+		return alpha, best
+
+	def tick(self):
+		self.nodes += 1
+		if not self.nodes % CHECK_EVERY and time.time() >= self.deadline:
+			raise SearchTimeout()
+
+	def order_key(self, ply):
+		killers = self.killers[ply] if ply < len(self.killers) else ()
+
+		def key(move):
+			if move.dest_piece:
+				return (1000 + 10 * piece_values[move.dest_piece.kind] -
+					move.source_piece.kind)
+			if move.is_promotion:
+				return 900 + piece_values[bitboard.TYPE_INDEX[
+							move.promotion or 'queen']] // 10
+			for i, killer in enumerate(killers):
+				if (killer is not None and
+						(move.source, move.dest) == killer):
+					return 500 - i
+			return 0
+		return key
+
+	def made_moves(self, moves):
+		"""Make each legal move in turn, unmaking it when the caller moves on.
+
+		Closing the generator unmakes the current move, so the board is
+		restored even when a search is abandoned."""
+		board = self.board
+		us = bitboard.COLOR_INDEX[board.turn]
+		for move in moves:
+			move.make()
+			try:
+				if not board.position.in_check(us):
+					yield move
+			finally:
+				move.unmake()
+
+	def is_repetition(self):
+		board = self.board
+		if board.halfmove < 4:
+			return False
+		return board.hash in self.history[-board.halfmove:]
+
+	def alpha_beta(self, depth, ply, alpha, beta):
+		self.tick()
+		board = self.board
+		if board.halfmove >= 100 or self.is_repetition():
+			return 0
+		if depth <= 0:
+			return self.quiesce(alpha, beta)
+		moves = list(chess.generate_pseudo_legal_moves(board, board.turn))
+		moves.sort(key=self.order_key(ply), reverse=True)
+		made = self.made_moves(moves)
+		self.history.append(board.hash)
+		try:
+			any_legal = False
+			for move in made:
+				any_legal = True
+				score = -self.alpha_beta(depth - 1, ply + 1, -beta, -alpha)
+				if score >= beta:
+					if not is_tactical(move) and ply < len(self.killers):
+						killers = self.killers[ply]
+						if killers[0] != (move.source, move.dest):
+							killers[1] = killers[0]
+							killers[0] = move.source, move.dest
+					return beta
+				if score > alpha:
+					alpha = score
+		finally:
+			made.close()
+			self.history.pop()
+		if not any_legal:
+			if board.position.in_check(bitboard.COLOR_INDEX[board.turn]):
+				return -MATE + ply
+			return 0
+		return alpha
+
+	def quiesce(self, alpha, beta):
+		self.tick()
+		board = self.board
+		stand_pat = evaluate(board)
+		if stand_pat >= beta:
+			return beta
+		if stand_pat > alpha:
+			alpha = stand_pat
+		moves = [move for move in
+			chess.generate_pseudo_legal_moves(board, board.turn)
+			if is_tactical(move)]
+		moves.sort(key=self.order_key(len(self.killers)), reverse=True)
+		made = self.made_moves(moves)
+		try:
+			for move in made:
+				score = -self.quiesce(-beta, -alpha)
+				if score >= beta:
+					return beta
+				if score > alpha:
+					alpha = score
+		finally:
+			made.close()
+		return alpha
+
+
+def search(board, time_budget=1.0, max_depth=64, report=None):
+	"""Find a move for the side to move within the time budget in seconds.
+
+	Returns the move and the Search, which records the nodes searched,
+	the depth reached and the elapsed time."""
+	searcher = Search(board, time_budget, max_depth)
+	return searcher.run(report), searcher
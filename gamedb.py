@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+"""An on-disk database of games and the positions they pass through.
+
+A database file holds, in order: a header; one record per position,
+holding the position in chess.board_to_bytes() form, its game and ply,
+and the move played from it; a table of games; and an index of
+(Zobrist hash, record) pairs sorted by hash.  Readers map the file with
+mmap and binary-search the index in place, so looking up a position
+reads only the pages it touches.
+"""
+from __future__ import print_function
+import chess
+import bitboard
+import validate
+from collections import Counter
+import argparse
+import heapq
+import mmap
+import struct
+import sys
+import tempfile
+
+MAGIC = b'CHESSDB\x01'
+header = struct.Struct('<8sQQQQ')
+record = struct.Struct('<32sIHBBB')
+game_entry = struct.Struct('<QIB3x')
+index_entry = struct.Struct('<QI')
+
+# Board bytes before the clocks; two records are the same position if
+# these match.
+POSITION_BYTES = 26
+NO_MOVE = 0xff
+# Index entries held in memory before they are sorted into a temporary file.
+RUN_LENGTH = 1 << 20
+results = ['*', '1-0', '0-1', '1/2-1/2']
+
+
+def _coords_name(sq):
+	file, rank = bitboard.coords(sq)
+	return "ABCDEFGH"[file] + "87654321"[rank]
+
+
+def move_shorthand(source, dest, promotion):
+	"""Return the shorthand for a move stored as square numbers.
+
+	promotion is 0 for none, or one more than the piece type."""
+	shorthand = "{} to {}".format(_coords_name(source), _coords_name(dest))
+	if promotion and promotion - 1 != bitboard.QUEEN:
+		shorthand += " " + bitboard.PIECE_TYPES[promotion - 1]
+	return shorthand
+
+
+class GameWriter(object):
+	"""Write a new database file, one game at a time.
+
+	Index entries are sorted in runs of RUN_LENGTH, each kept in a
+	temporary file, and the runs are merged into the index when the
+	writer is closed, so memory use does not grow with the database."""
+
+	def __init__(self, path):
+		self.file = open(path, 'wb')
+		self.file.write(b'\0' * header.size)
+		self.games = []
+		self.entries = []
+		self.runs = []
+		self.positions = 0
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def add_game(self, moves, fen=None, result='*', notation='shorthand'):
+		"""Replay a game and store its positions.
+
+		notation is 'shorthand' or 'san'.  Raises ValueError, and stores
+		nothing, if a move is illegal."""
+		board = chess.board_from_fen(fen) if fen else chess.new_board()
+		game = len(self.games)
+		first = self.positions
+		data = []
+		for ply, shorthand in enumerate(moves):
+			if notation == 'san':
+				move = chess.Move.from_san(board, shorthand)
+			else:
+				move = chess.Move.from_shorthand(board, shorthand)
+				if not move.is_legal():
+					raise ValueError("Illegal move: " + shorthand)
+			promotion = 0
+			if move.is_promotion:
+				promotion = bitboard.TYPE_INDEX[move.promotion or 'queen'] + 1
+			data.append((board.hash, record.pack(chess.board_to_bytes(board),
+				game, ply, chess.square(move.source),
+				chess.square(move.dest), promotion)))
+			move.make()
+		data.append((board.hash, record.pack(chess.board_to_bytes(board),
+			game, len(moves), NO_MOVE, NO_MOVE, 0)))
+		for key, packed in data:
+			self.file.write(packed)
+			self.entries.append((key, self.positions))
+			self.positions += 1
+		if len(self.entries) >= RUN_LENGTH:
+			self._spill()
+		self.games.append((first, len(data), results.index(result)
+			if result in results else 0))
+		return game
+
+	def _spill(self):
+		"""Sort the index entries in memory and move them to a run file."""
+		self.entries.sort()
+		run = tempfile.TemporaryFile()
+		run.write(b''.join(index_entry.pack(*entry) for entry in self.entries))
+		run.seek(0)
+		self.runs.append(run)
+		self.entries = []
+
+	@staticmethod
+	def _read_run(run):
+		while True:
+			data = run.read(index_entry.size * 4096)
+			if not data:
+				return
+			for entry in index_entry.iter_unpack(data):
+				yield entry
+
+	def close(self):
+		if self.file.closed:
+			return
+		games_offset = self.file.tell()
+		for entry in self.games:
+			self.file.write(game_entry.pack(*entry))
+		index_offset = self.file.tell()
+		if self.runs:
+			self._spill()
+			entries = heapq.merge(*[self._read_run(run) for run in self.runs])
+		else:
+			self.entries.sort()
+			entries = self.entries
+		chunk = []
+		for entry in entries:
+			chunk.append(index_entry.pack(*entry))
+			if len(chunk) >= 4096:
+				self.file.write(b''.join(chunk))
+				chunk = []
+		self.file.write(b''.join(chunk))
+		for run in self.runs:
+			run.close()
+		self.file.seek(0)
+		self.file.write(header.pack(MAGIC, len(self.games), self.positions,
+			games_offset, index_offset))
+		self.file.close()
+		self.entries = []
+		self.runs = []
+
+
+class GameDatabase(object):
+	"""Read-only access to a database file through mmap."""
+
+	def __init__(self, path):
+		self.file = open(path, 'rb')
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		(magic, self.game_count, self.position_count, self.games_offset,
+			self.index_offset) = header.unpack_from(self.map, 0)
+		if magic != MAGIC:
+			self.close()
+			raise ValueError("Not a game database: " + path)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def close(self):
+		self.map.close()
+		self.file.close()
+
+	def __len__(self):
+		return self.game_count
+
+	def record(self, n):
+		"""Return (board bytes, game, ply, source, dest, promotion) of a record."""
+		return record.unpack_from(self.map, header.size + n * record.size)
+
+	def board_at(self, n):
+		"""Return the board of a position record."""
+		return chess.board_from_bytes(self.record(n)[0])
+
+	def game(self, n):
+		"""Return the result and the shorthand moves of a game."""
+		first, count, result = game_entry.unpack_from(self.map,
+			self.games_offset + n * game_entry.size)
+		moves = []
+		for i in range(first, first + count - 1):
+			moves.append(move_shorthand(*self.record(i)[3:]))
+		return results[result], moves
+
+	def _index_key(self, i):
+		return index_entry.unpack_from(self.map,
+			self.index_offset + i * index_entry.size)
+
+	def lookup(self, board):
+		"""Return the numbers of every record holding the board's position."""
+		key = board.hash
+		low, high = 0, self.position_count
+		while low < high:
+			middle = (low + high) // 2
+			if self._index_key(middle)[0] < key:
+				low = middle + 1
+			else:
+				high = middle
+		wanted = chess.board_to_bytes(board)[:POSITION_BYTES]
+		found = []
+		while low < self.position_count:
+			entry_key, n = self._index_key(low)
+			if entry_key != key:
+				break
+			if self.record(n)[0][:POSITION_BYTES] == wanted:
+				found.append(n)
+			low += 1
+		return found
+
+	def games_reaching(self, board):
+		"""Return (game, ply) for every time a game reached the position."""
+		return sorted(self.record(n)[1:3] for n in self.lookup(board))
+
+	def next_moves(self, board):
+		"""Count the moves played from the position, most common first."""
+		counts = Counter()
+		for n in self.lookup(board):
+			source, dest, promotion = self.record(n)[3:]
+			if source != NO_MOVE:
+				counts[move_shorthand(source, dest, promotion)] += 1
+		return counts.most_common()
+
+
+parser = argparse.ArgumentParser(description="Build or query a game database.")
+subparsers = parser.add_subparsers(dest='command')
+build_parser = subparsers.add_parser('build',
+		help="Build a database from shorthand logs or PGN files.")
+build_parser.add_argument('database')
+build_parser.add_argument('logs', nargs='+',
+		help="Shorthand logs, or PGN files ending in .pgn.")
+query_parser = subparsers.add_parser('query',
+		help="Show the games and next moves from a position.")
+query_parser.add_argument('database')
+query_parser.add_argument('fen')
+
+
+def main_cli():
+	"""Get options from the command-line flags, then build or query."""
+	opts = parser.parse_args()
+	if opts.command == 'build':
+		with GameWriter(opts.database) as writer:
+			for name in opts.logs:
+				with open(name) as stream:
+					for game in validate.read_games(stream, name):
+						try:
+							writer.add_game(game.moves, game.fen,
+								game.tags.get('Result', '*'), game.notation)
+						except ValueError as e:
+							print("{}: skipped game: {}".format(name, e),
+								file=sys.stderr)
+		print("{} games, {} positions".format(len(writer.games),
+			writer.positions))
+	elif opts.command == 'query':
+		with GameDatabase(opts.database) as database:
+			board = chess.board_from_fen(opts.fen)
+			for game, ply in database.games_reaching(board):
+				print("game {} ply {}".format(game, ply))
+			for shorthand, count in database.next_moves(board):
+				print("{}: {}".format(shorthand, count))
+	else:
+		parser.print_usage()
+
+
+if __name__ == '__main__':
+	main_cli()
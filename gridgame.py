@@ -3,6 +3,11 @@ from pygame import Surface
 from os import path
 from collections import defaultdict
 
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 UP = lambda coords: (coords[0], coords[1] - 1)
 DOWN = lambda coords: (coords[0], coords[1] + 1)
 LEFT = lambda coords: (coords[0] - 1, coords[1])
@@ -24,20 +29,37 @@ def exists(cell, test=True):
 	return bool(cell)
 
 
+# The side, in cells, of the square buckets World indexes objects by.
+BUCKET_SIZE = 16
+# An entity with more cells than this marks the whole view for redrawing
+# when it changes, rather than marking each of its cells.
+DIRTY_LIMIT = 1024
+
+# Filled surfaces for colored cells, by color and unit size.
+_color_surfs = {}
+
+
+def get_color_surf(rgb, size):
+	try:
+		return _color_surfs[rgb, size]
+	except KeyError:
+		pass
+	surf = _color_surfs[rgb, size] = Surface(size)
+	surf.fill(rgb)
+	return surf
+
+
 def get_surf(cell, world):
 	try:
 		return cell.surface
 	except AttributeError:
 		pass
+	size = world.unit_x, world.unit_y
 	try:
-		surf = Surface((world.unit_x, world.unit_y))
-		surf.fill(cell.rgb)
-		return surf
+		return get_color_surf(cell.rgb, size)
 	except AttributeError:
 		pass
-	surf = Surface((world.unit_x, world.unit_y))
-	surf.fill((255, 255, 255))
-	return surf
+	return get_color_surf((255, 255, 255), size)
 
 
 class RGB(object):
@@ -46,19 +68,51 @@ class RGB(object):
 
 
 class Texture(object):
-	def __init__(self, image_path):
+	def __init__(self, image_path, alpha=True):
 		if image_path.startswith('/'):
 			full_path = image_path
 		else:
 			main_file = __file__
 			realpath = path.realpath(main_file)
 			full_path = path.join(path.dirname(realpath), image_path)
-		self.surface = pygame.image.load(full_path)
+		self.image = pygame.image.load(full_path)
+		self.alpha = alpha
+		self.converted = None
+
+	@property
+	def surface(self):
+		"""The image in the display's pixel format, converted once.
+
+		Until the display is set up the image is returned as loaded."""
+		if self.converted is None:
+			if pygame.display.get_surface() is None:
+				return self.image
+			if self.alpha:
+				self.converted = self.image.convert_alpha()
+			else:
+				self.converted = self.image.convert()
+		return self.converted
 
 
 class GridEntity(object):
-	coords = 0, 0
+	_coords = 0, 0
 	world = None
+	# Static entities are drawn once into the world's background layer.
+	static = False
+
+	@property
+	def coords(self):
+		return self._coords
+
+	@coords.setter
+	def coords(self, val):
+		if val == self._coords:
+			return
+		self.invalidate()
+		self._coords = tuple(val)
+		self.invalidate()
+		if self.world is not None:
+			self.world.index_obj(self)
 
 	@property
 	def x(self):
@@ -76,15 +130,49 @@ class GridEntity(object):
 	def y(self, val):
 		self.coords =  self.coords[0], val
 
-	def __init__(self, grid=[[None]], coords=(0, 0), world=None):
+	def __init__(self, grid=[[None]], coords=(0, 0), world=None, static=False):
 		self.grid = grid
 		self.coords = coords
+		self.static = static
 		if world:
 			world.add_obj(self)
 
 	def normalize_coords(self, coords):
 		return coords[0] + self.x, coords[1] + self.y
 
+	def area(self):
+		return sum(len(col or ()) for col in self.grid)
+
+	def bounds(self):
+		"""Return the left, top, right and bottom edges of the grid.
+
+		The right and bottom edges are just outside it."""
+		height = max([len(col or ()) for col in self.grid] or [0])
+		return self.x, self.y, self.x + len(self.grid), self.y + height
+
+	def filled_cells(self):
+		"""Yield the grid coordinates of every cell that exists."""
+		for x, col in enumerate(self.grid):
+			for y, cell in enumerate(col or ()):
+				if exists(cell):
+					yield x, y
+
+	def invalidate(self, cells=None):
+		"""Mark cells, given in grid coordinates, as needing a redraw.
+
+		With no cells, every cell that exists is marked, or the whole view
+		if the entity has more than DIRTY_LIMIT cells."""
+		if self.world is None:
+			return
+		if self.static:
+			self.world.background = None
+		if cells is None:
+			if self.area() > DIRTY_LIMIT:
+				self.world.redraw_all()
+				return
+			cells = self.filled_cells()
+		self.world.mark_dirty(self.normalize_coords(cell) for cell in cells)
+
 	def get_normal(self, coords):
 		x = coords[0] - self.x
 		y = coords[1] - self.y
@@ -98,6 +186,7 @@ class GridEntity(object):
 		if x < 0 or y < 0:
 			return None
 		self.grid[x][y] = val
+		self.invalidate([(x, y)])
 
 	def check_normal_in(self, coords):
 		x = self.x < coords[0] < self.x + len(self.grid[0])
@@ -114,13 +203,20 @@ class GridEntity(object):
 		return False
 
 	def shares_coords_world(self):
-		return self.shares_coords_any(self.world)
+		return self.shares_coords_any(self.world.objs_at(self.coords))
 
 	def does_collide(self, obj, req_exist=(True, True)):
+		"""Check whether the two grids both hold a cell at some place.
+
+		Only places inside both grids are compared.  req_exist says, for
+		each grid in turn, whether its cell there has to exist."""
 		for x, col in enumerate(self):
 			for y, cell1 in enumerate(col):
+				coords = self.normalize_coords((x, y))
+				if coords[0] < obj.x or coords[1] < obj.y:
+					continue
 				try:
-					cell2 = obj.get_normal(self.normalize_coords((x, y)))
+					cell2 = obj.get_normal(coords)
 				except IndexError:
 					pass
 				else:
@@ -129,13 +225,19 @@ class GridEntity(object):
 		return False
 
 	def does_collide_any(self, objs, req_exist=(True, True)):
+		world = self.world
+		nearby = world.objs_near(self) if world is not None else ()
 		for obj in objs:
-			if obj != self and self.does_collide(obj, req_exist):
+			if obj is self:
+				continue
+			if world is not None and obj.world is world and obj not in nearby:
+				continue
+			if self.does_collide(obj, req_exist):
 				return True
 		return False
 
 	def does_collide_world(self, req_exist=(True, True)):
-		return self.does_collide_any(self.world)
+		return self.does_collide_any(self.world.objs_near(self), req_exist)
 
 	def merge(self, obj):
 		new = self.copy()
@@ -154,7 +256,11 @@ class GridEntity(object):
 		return type(self)(grid, (self.x, self.y))
 
 	def set_grid(self, grid):
+		self.invalidate()
 		self.grid = grid
+		self.invalidate()
+		if self.world is not None:
+			self.world.index_obj(self)
 
 	def __iter__(self):
 		return iter(self.grid)
@@ -176,17 +282,249 @@ class GridEntity(object):
 		if sub[0] < 0:
 			raise IndexError
 		if len(sub) == 1:
+			old = self.grid[sub[0]]
 			self.grid[sub[0]] = val
+			self.invalidate((sub[0], y)
+				for y in range(max(len(old or ()), len(val or ()))))
+			if self.world is not None:
+				self.world.index_obj(self)
 		else:
 			self.grid[sub[0]][sub[1]] = val
+			self.invalidate([sub])
 
 	def __delitem__(self, sub):
 		if sub[0] < 0:
 			raise IndexError
 		if len(sub) == 1:
+			self.invalidate((sub[0], y) for y in range(len(self.grid[sub[0]])))
 			self.grid[sub[0]] = None
+			if self.world is not None:
+				self.world.index_obj(self)
 		else:
 			self.grid[sub[0]][sub[1]] = None
+			self.invalidate([sub])
+
+
+class ArrayColumn(object):
+	"""A column of an ArrayGridEntity, read and written like a list."""
+
+	def __init__(self, entity, x):
+		self.entity = entity
+		self.x = x
+
+	def __len__(self):
+		return self.entity.ids.shape[1]
+
+	def __iter__(self):
+		table = self.entity.table
+		return iter([table[i] for i in self.entity.ids[self.x].tolist()])
+
+	def __getitem__(self, y):
+		return self.entity.table[self.entity.ids[self.x, y]]
+
+	def __setitem__(self, y, val):
+		self.entity[self.x, y] = val
+
+
+class ArrayGridEntity(GridEntity):
+	"""A GridEntity whose grid is a NumPy array of cell IDs.
+
+	ids[x, y] indexes table, which holds each distinct cell object once;
+	ID 0 is None.  Indexing, iteration and assignment behave as for a
+	list grid, but copies, merges, collisions and fills work on whole
+	arrays at a time.  Requires NumPy."""
+
+	def __init__(self, grid=[[None]], coords=(0, 0), world=None, static=False):
+		if numpy is None:
+			raise ImportError("ArrayGridEntity requires NumPy")
+		GridEntity.__init__(self, grid, coords, world, static)
+
+	@classmethod
+	def blank(cls, width, height, coords=(0, 0), world=None, static=False):
+		"""Create an entity of the given size with every cell None."""
+		entity = cls([], coords, static=static)
+		entity.ids = numpy.zeros((width, height), dtype=numpy.int32)
+		if world:
+			world.add_obj(entity)
+		return entity
+
+	@property
+	def grid(self):
+		table = self.table
+		return [[table[i] for i in col] for col in self.ids.tolist()]
+
+	@grid.setter
+	def grid(self, grid):
+		self.table = [None]
+		self._cell_ids = {id(None): 0}
+		width = len(grid)
+		height = max(len(col) for col in grid) if width else 0
+		self.ids = numpy.zeros((width, height), dtype=numpy.int32)
+		for x, col in enumerate(grid):
+			self.ids[x, :len(col)] = [self.cell_id(cell) for cell in col]
+
+	def cell_id(self, cell):
+		"""Return the ID of a cell object, adding it to the table if new."""
+		try:
+			return self._cell_ids[id(cell)]
+		except KeyError:
+			pass
+		n = self._cell_ids[id(cell)] = len(self.table)
+		self.table.append(cell)
+		return n
+
+	def mask(self, test=True):
+		"""Return a boolean array of the cells that exist."""
+		if not test:
+			return numpy.ones(self.ids.shape, dtype=bool)
+		existing = numpy.array([exists(cell) for cell in self.table],
+			dtype=bool)
+		return existing[self.ids]
+
+	def overlap(self, obj):
+		"""Return the slices of this grid and another's that share cells.
+
+		Returns None if they do not overlap."""
+		bounds, other = self.bounds(), obj.bounds()
+		left, top = max(bounds[0], other[0]), max(bounds[1], other[1])
+		right, bottom = min(bounds[2], other[2]), min(bounds[3], other[3])
+		if left >= right or top >= bottom:
+			return None
+		mine = (slice(left - self.x, right - self.x),
+			slice(top - self.y, bottom - self.y))
+		theirs = (slice(left - obj.x, right - obj.x),
+			slice(top - obj.y, bottom - obj.y))
+		return mine, theirs
+
+	def area(self):
+		return self.ids.size
+
+	def bounds(self):
+		width, height = self.ids.shape
+		return self.x, self.y, self.x + width, self.y + height
+
+	def filled_cells(self):
+		xs, ys = numpy.nonzero(self.mask())
+		return zip(xs.tolist(), ys.tolist())
+
+	def get_normal(self, coords):
+		x = coords[0] - self.x
+		y = coords[1] - self.y
+		if x < 0 or y < 0:
+			return None
+		return self.table[self.ids[x, y]]
+
+	def set_normal(self, coords, val):
+		x = coords[0] - self.x
+		y = coords[1] - self.y
+		if x < 0 or y < 0:
+			return None
+		self.ids[x, y] = self.cell_id(val)
+		self.invalidate([(x, y)])
+
+	def check_normal_in(self, coords):
+		width, height = self.ids.shape
+		x = self.x < coords[0] < self.x + height
+		y = self.y < coords[1] < self.y + width
+		return x and y
+
+	def does_collide(self, obj, req_exist=(True, True)):
+		slices = self.overlap(obj)
+		if slices is None:
+			return False
+		mine, theirs = slices
+		if not isinstance(obj, ArrayGridEntity):
+			# Only the overlapping part of a list grid is read.
+			mask = self.mask(req_exist[0])[mine]
+			for x in range(theirs[0].start, theirs[0].stop):
+				col = obj.grid[x] or ()
+				for y in range(theirs[1].start, min(theirs[1].stop, len(col))):
+					if (mask[x - theirs[0].start, y - theirs[1].start] and
+							exists(col[y], req_exist[1])):
+						return True
+			return False
+		return bool((self.mask(req_exist[0])[mine] &
+			obj.mask(req_exist[1])[theirs]).any())
+
+	def merge(self, obj):
+		if not isinstance(obj, ArrayGridEntity):
+			return GridEntity.merge(self, obj)
+		new = self.copy()
+		slices = new.overlap(obj)
+		if slices is None:
+			return new
+		mine, theirs = slices
+		remap = numpy.array([new.cell_id(cell) for cell in obj.table],
+			dtype=numpy.int32)
+		where = obj.mask()[theirs]
+		new.ids[mine][where] = remap[obj.ids[theirs][where]]
+		return new
+
+	def copy(self):
+		new = type(self).blank(0, 0, (self.x, self.y))
+		new.ids = self.ids.copy()
+		new.table = list(self.table)
+		new._cell_ids = dict(self._cell_ids)
+		return new
+
+	def fill(self, val, region=None, where=None):
+		"""Set many cells to one value.
+
+		region is (x, y, width, height) in grid coordinates, or None for
+		the whole grid; where is an optional boolean array, the size of the
+		region, choosing which of its cells to set."""
+		if region is None:
+			x, y = 0, 0
+			width, height = self.ids.shape
+		else:
+			x, y, width, height = region
+		area = self.ids[x:x + width, y:y + height]
+		if where is None:
+			where = numpy.ones(area.shape, dtype=bool)
+		area[where] = self.cell_id(val)
+		if numpy.count_nonzero(where) > DIRTY_LIMIT:
+			self.invalidate()
+			return
+		xs, ys = numpy.nonzero(where)
+		self.invalidate(zip((xs + x).tolist(), (ys + y).tolist()))
+
+	def __iter__(self):
+		return iter([ArrayColumn(self, x) for x in range(self.ids.shape[0])])
+
+	def __len__(self):
+		return self.ids.shape[0]
+
+	def __getitem__(self, sub):
+		if sub[0] < 0:
+			raise IndexError
+		if len(sub) == 1:
+			if sub[0] >= self.ids.shape[0]:
+				raise IndexError
+			return ArrayColumn(self, sub[0])
+		else:
+			if sub[1] < 0:
+				raise IndexError
+			return self.table[self.ids[sub[0], sub[1]]]
+
+	def __setitem__(self, sub, val):
+		if sub[0] < 0:
+			raise IndexError
+		if len(sub) == 1:
+			self.ids[sub[0]] = [self.cell_id(cell) for cell in val]
+			self.invalidate((sub[0], y) for y in range(self.ids.shape[1]))
+		else:
+			self.ids[sub[0], sub[1]] = self.cell_id(val)
+			self.invalidate([sub])
+
+	def __delitem__(self, sub):
+		if sub[0] < 0:
+			raise IndexError
+		if len(sub) == 1:
+			self.ids[sub[0]] = 0
+			self.invalidate((sub[0], y) for y in range(self.ids.shape[1]))
+		else:
+			self.ids[sub[0], sub[1]] = 0
+			self.invalidate([sub])
 
 
 class World(object):
@@ -195,47 +533,246 @@ class World(object):
 	draw_y = 0
 	unit_x = 25
 	unit_y = 25
+	# The view transform: swap the axes, then mirror the view left to
+	# right and top to bottom.  Only the drawing changes, never the grids.
+	transpose = False
+	flip_x = False
+	flip_y = False
 
 	def __init__(self, surf=None):
 		self._objs = []
+		# Objects by the buckets their bounds overlap, the bounds and
+		# buckets each object was last indexed under, and drawing order.
+		self._buckets = defaultdict(set)
+		self._bounds = {}
+		self._bucket_ranges = {}
+		self._order = {}
+		self._added = 0
 		self.surf = surf
+		self.dirty = set()
+		self.full_redraw = True
+		self.background = None
+		self.background_view = None
 
 	def add_obj(self, obj):
 		obj.world = self
 		self._objs.append(obj)
+		self._order[obj] = self._added
+		self._added += 1
+		self.index_obj(obj)
+		obj.invalidate()
 
 	def remove_obj(self, obj):
+		obj.invalidate()
+		self.unindex_obj(obj)
+		del self._order[obj]
 		self._objs.remove(obj)
 		obj.world = None
 
+	@staticmethod
+	def _bucket_range(bounds):
+		left, top, right, bottom = bounds
+		return (left // BUCKET_SIZE, top // BUCKET_SIZE,
+			(right - 1) // BUCKET_SIZE + 1, (bottom - 1) // BUCKET_SIZE + 1)
+
+	@staticmethod
+	def _buckets_in(bucket_range):
+		left, top, right, bottom = bucket_range
+		for x in range(left, right):
+			for y in range(top, bottom):
+				yield x, y
+
+	def index_obj(self, obj):
+		"""Record the bounds of an object, after it moves or changes size.
+
+		The object is filed under only the buckets its bounds overlap, so
+		a move within them costs nothing more than noting the new bounds."""
+		bounds = obj.bounds()
+		self._bounds[obj] = bounds
+		if bounds[0] >= bounds[2] or bounds[1] >= bounds[3]:
+			bucket_range = 0, 0, 0, 0
+		else:
+			bucket_range = self._bucket_range(bounds)
+		old_range = self._bucket_ranges.get(obj)
+		if bucket_range == old_range:
+			return
+		if old_range is not None:
+			self._unfile(obj, old_range)
+		for bucket in self._buckets_in(bucket_range):
+			self._buckets[bucket].add(obj)
+		self._bucket_ranges[obj] = bucket_range
+
+	def unindex_obj(self, obj):
+		self._bounds.pop(obj, None)
+		bucket_range = self._bucket_ranges.pop(obj, None)
+		if bucket_range is not None:
+			self._unfile(obj, bucket_range)
+
+	def _unfile(self, obj, bucket_range):
+		for bucket in self._buckets_in(bucket_range):
+			objs = self._buckets[bucket]
+			objs.discard(obj)
+			if not objs:
+				del self._buckets[bucket]
+
+	def objs_at(self, coords):
+		"""Return the objects whose bounds hold a cell, in drawing order."""
+		x, y = coords
+		objs = self._buckets.get((x // BUCKET_SIZE, y // BUCKET_SIZE))
+		if not objs:
+			return []
+		found = []
+		for obj in objs:
+			left, top, right, bottom = self._bounds[obj]
+			if left <= x < right and top <= y < bottom:
+				found.append(obj)
+		found.sort(key=self._order.__getitem__)
+		return found
+
+	def objs_near(self, obj):
+		"""Return the set of other objects whose bounds overlap an object's."""
+		left, top, right, bottom = self._bounds[obj]
+		near = set()
+		for bucket in self._buckets_in(self._bucket_ranges[obj]):
+			for other in self._buckets.get(bucket, ()):
+				if other in near or other is obj:
+					continue
+				other_left, other_top, other_right, other_bottom = (
+					self._bounds[other])
+				if (other_left < right and left < other_right and
+						other_top < bottom and top < other_bottom):
+					near.add(other)
+		return near
+
+	def mark_dirty(self, cells):
+		"""Mark cells, given in world coordinates, as needing a redraw."""
+		self.dirty.update(cells)
+
+	def redraw_all(self):
+		self.full_redraw = True
+
+	def set_rotation(self, degrees):
+		"""Rotate the view clockwise by a multiple of 90 degrees."""
+		turns = degrees // 90 % 4
+		self.transpose = turns in (1, 3)
+		self.flip_x = turns in (1, 2)
+		self.flip_y = turns in (2, 3)
+		self.redraw_all()
+
+	def normal_to_view(self, coords):
+		"""Return the column and row of the view that shows a cell."""
+		x, y = (coords[0] - self.draw_x), (coords[1] - self.draw_y)
+		if self.transpose:
+			x, y = y, x
+		if self.flip_x or self.flip_y:
+			width, height = self.view_size()
+			if self.flip_x:
+				x = width - 1 - x
+			if self.flip_y:
+				y = height - 1 - y
+		return x, y
+
+	def view_to_normal(self, coords):
+		"""Return the cell shown at a column and row of the view."""
+		x, y = coords
+		if self.flip_x or self.flip_y:
+			width, height = self.view_size()
+			if self.flip_x:
+				x = width - 1 - x
+			if self.flip_y:
+				y = height - 1 - y
+		if self.transpose:
+			x, y = y, x
+		return (x + self.draw_x), (y + self.draw_y)
+
+	def in_view(self, coords):
+		x, y = self.normal_to_view(coords)
+		width, height = self.view_size()
+		return 0 <= x < width and 0 <= y < height
+
+	def view_step(self, coords, direction):
+		"""Return the cell next to another in a direction on the screen."""
+		return self.view_to_normal(direction(self.normal_to_view(coords)))
+
 	def win_to_normal(self, coords):
 		x = coords[0] / self.unit_x
 		y = coords[1] / self.unit_y
-		x, y = int(x), int(y)
-		x, y = (x + self.draw_x), (y + self.draw_y)
-		return x, y
+		return self.view_to_normal((int(x), int(y)))
 
 	def normal_to_win(self, coords):
-		x, y = (coords[0] - self.draw_x), (coords[1] - self.draw_y)
+		x, y = self.normal_to_view(coords)
 		x *= self.unit_x
 		y *= self.unit_y
 		return x, y
 
-	def draw(self):
-		self.surf.fill(self.rgb)
+	def view_size(self):
 		width, height = self.surf.get_width(), self.surf.get_height()
-		width = int(width / self.unit_x)
-		height = int(height / self.unit_y)
-		for x in range(self.draw_x, width + self.draw_x):
-			for y in range(self.draw_y, height + self.draw_y):
-				for cell, _ in self[x, y]:
-					if exists(cell):
-						draw_coords = self.normal_to_win((x, y))
-						self.surf.blit(get_surf(cell, self), draw_coords)
-		pygame.display.flip()
+		return int(width / self.unit_x), int(height / self.unit_y)
 
-	def __getitem__(self, tup):
+	def view(self):
+		width, height = self.surf.get_width(), self.surf.get_height()
+		return (self.draw_x, self.draw_y, self.unit_x, self.unit_y,
+			width, height, self.transpose, self.flip_x, self.flip_y)
+
+	def update_background(self):
+		"""Draw the static entities into the background layer if it is stale."""
+		view = self.view()
+		if self.background is not None and self.background_view == view:
+			return
+		background = Surface((view[4], view[5]))
+		background.fill(self.rgb)
 		for obj in self:
+			if not obj.static:
+				continue
+			for x, col in enumerate(obj):
+				for y, cell in enumerate(col):
+					coords = obj.normalize_coords((x, y))
+					if exists(cell) and self.in_view(coords):
+						background.blit(get_surf(cell, self),
+							self.normal_to_win(coords))
+		self.background = background
+		self.background_view = view
+
+	def draw_cell(self, coords):
+		draw_coords = self.normal_to_win(coords)
+		rect = pygame.Rect(draw_coords, (self.unit_x, self.unit_y))
+		self.surf.blit(self.background, draw_coords, rect)
+		for cell, obj in self[coords]:
+			if not obj.static and exists(cell):
+				self.surf.blit(get_surf(cell, self), draw_coords)
+		return rect
+
+	def draw(self):
+		"""Draw the cells marked dirty since the last draw.
+
+		The first draw, and any after redraw_all(), draws everything.
+		Static entities come from the background layer, which is only
+		redrawn when one of them changes."""
+		self.update_background()
+		if self.full_redraw:
+			self.full_redraw = False
+			self.dirty.clear()
+			self.surf.blit(self.background, (0, 0))
+			width, height = self.view_size()
+			for view_x in range(width):
+				for view_y in range(height):
+					coords = self.view_to_normal((view_x, view_y))
+					draw_coords = view_x * self.unit_x, view_y * self.unit_y
+					for cell, obj in self[coords]:
+						if not obj.static and exists(cell):
+							self.surf.blit(get_surf(cell, self), draw_coords)
+			pygame.display.flip()
+			return
+		rects = []
+		for coords in self.dirty:
+			if self.in_view(coords):
+				rects.append(self.draw_cell(coords))
+		self.dirty.clear()
+		if rects:
+			pygame.display.update(rects)
+
+	def __getitem__(self, tup):
+		for obj in self.objs_at(tup):
 			try:
 				val = obj.get_normal(tup)
 				if val:
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+"""Explore the move tree on several cores by splitting the root moves.
+
+Each root move is sent to a worker process together with the position in
+the 32-byte form given by chess.board_to_bytes(), so no Piece objects or
+textures are pickled.  The pool is kept between calls, so a TreeExplorer
+should be created once and reused.
+"""
+import chess
+import perft
+import bitboard
+from concurrent.futures import ProcessPoolExecutor
+
+
+def move_key(move):
+	"""Return the plain (source, dest, promotion) tuple for a move."""
+	return move.source, move.dest, move.promotion
+
+
+def _make(packed, key):
+	board = chess.board_from_bytes(packed)
+	move = chess.Move(board, *key)
+	move.make()
+	return board, move
+
+
+def _perft_task(packed, key, depth):
+	board, move = _make(packed, key)
+	return move.shorthand, perft.perft(board, depth)
+
+
+def _mate_task(packed, key, n):
+	board, move = _make(packed, key)
+	return move.shorthand, delivers_mate(board, n)
+
+
+def is_checkmate(board):
+	"""Check whether the side to move is checkmated."""
+	return (not chess.has_legal_move(board, board.turn) and
+		board.position.in_check(bitboard.COLOR_INDEX[board.turn]))
+
+
+def can_mate(board, n):
+	"""Check whether the side to move can force mate within n moves."""
+	for move in list(chess.generate_legal_moves(board, board.turn)):
+		move.make()
+		try:
+			if delivers_mate(board, n):
+				return True
+		finally:
+			move.unmake()
+	return False
+
+
+def delivers_mate(board, n):
+	"""Check whether the move just made forces mate within n moves.
+
+	The board is the position after the move, with the defender to move."""
+	replies = list(chess.generate_legal_moves(board, board.turn))
+	if not replies:
+		return is_checkmate(board)
+	if n <= 1:
+		return False
+	for reply in replies:
+		reply.make()
+		try:
+			if not can_mate(board, n - 1):
+				return False
+		finally:
+			reply.unmake()
+	return True
+
+
+class TreeExplorer(object):
+	"""A reusable process pool for perft counts and mate searches.
+
+	workers is the number of processes, by default one per core."""
+
+	def __init__(self, workers=None):
+		self.pool = ProcessPoolExecutor(workers)
+
+	def close(self):
+		self.pool.shutdown()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def _map(self, task, board, arg):
+		packed = chess.board_to_bytes(board)
+		futures = [self.pool.submit(task, packed, move_key(move), arg)
+			for move in chess.generate_legal_moves(board, board.turn)]
+		return dict(future.result() for future in futures)
+
+	def divide(self, board, depth):
+		"""Return the perft count below each root move, keyed by shorthand."""
+		return self._map(_perft_task, board, depth - 1)
+
+	def perft(self, board, depth):
+		"""Count the leaf nodes of the legal move tree to the given depth."""
+		if depth <= 1:
+			return perft.perft(board, depth)
+		return sum(self.divide(board, depth).values())
+
+	def find_mates(self, board, n):
+		"""Return the shorthand of every root move that forces mate in n."""
+		results = self._map(_mate_task, board, n)
+		return sorted(shorthand for shorthand, mates in results.items()
+			if mates)
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+"""Count the leaf nodes of the move tree to check and benchmark the rules."""
+from __future__ import print_function
+import chess
+import argparse
+import sys
+import time
+
+start_fen = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+# Published node counts for depths 1, 2, 3, ...
+positions = [
+	('start', start_fen,
+		[20, 400, 8902, 197281, 4865609, 119060324]),
+	('kiwipete',
+		'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+		[48, 2039, 97862, 4085603, 193690690]),
+	('position3', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+		[14, 191, 2812, 43238, 674624, 11030083]),
+	('position4',
+		'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+		[6, 264, 9467, 422333, 15833292]),
+	('position5',
+		'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+		[44, 1486, 62379, 2103487, 89941194]),
+	('position6',
+		'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+		[46, 2079, 89890, 3894594, 164075551]),
+]
+
+parser = argparse.ArgumentParser(description="Run perft on chess positions.")
+parser.add_argument('-d', '--depth', type=int, default=3,
+		help="The depth to count to.")
+parser.add_argument('-p', '--position', action='append',
+		choices=[name for name, _, _ in positions],
+		help="A reference position to run; may be repeated (default: all).")
+parser.add_argument('-f', '--fen', help="Run on a FEN position instead.")
+parser.add_argument('--divide', action='store_true',
+		help="Print the node count below each root move.")
+parser.add_argument('--validate', action='store_true',
+		help="Also check every generated move with Move.is_valid.")
+parser.add_argument('-j', '--jobs', type=int, default=1,
+		help="Split the root moves across this many processes.")
+
+
+def perft(board, depth, validate=False):
+	"""Count the leaf nodes of the legal move tree to the given depth.
+
+	With validate set, every generated move is also run through
+	Move.is_valid, and a ValueError is raised if it disagrees."""
+	moves = list(chess.generate_legal_moves(board, board.turn))
+	if validate:
+		for move in moves:
+			if not move.is_valid():
+				raise ValueError("Generated move fails validation: " +
+						move.shorthand)
+	if depth <= 1:
+		return len(moves) if depth == 1 else 1
+	nodes = 0
+	for move in moves:
+		move.make()
+		nodes += perft(board, depth - 1, validate)
+		move.unmake()
+	return nodes
+
+
+def divide(board, depth):
+	"""Return the perft count below each root move, keyed by shorthand."""
+	counts = {}
+	for move in list(chess.generate_legal_moves(board, board.turn)):
+		move.make()
+		counts[move.shorthand] = perft(board, depth - 1)
+		move.unmake()
+	return counts
+
+
+def run(name, fen, depth, expected=None, show_divide=False, validate=False,
+		out=sys.stdout, explorer=None):
+	"""Run perft to each depth up to depth, reporting speed and correctness.
+
+	If explorer is given, a parallel.TreeExplorer, the counts are split
+	across its processes.  Returns False if any count differs from the
+	expected values."""
+	board = chess.board_from_fen(fen)
+	ok = True
+	for ply in range(1, depth + 1):
+		began = time.time()
+		if explorer is not None:
+			nodes = explorer.perft(board, ply)
+		else:
+			nodes = perft(board, ply, validate)
+		elapsed = time.time() - began
+		nps = nodes / elapsed if elapsed else float('inf')
+		if expected and ply <= len(expected):
+			if nodes == expected[ply - 1]:
+				verdict = "ok"
+			else:
+				verdict = "MISMATCH (expected {})".format(expected[ply - 1])
+				ok = False
+		else:
+			verdict = "no reference"
+		print("{} depth {}: {} nodes in {:.2f}s, {:.0f} nodes/s, {}".format(
+			name, ply, nodes, elapsed, nps, verdict), file=out)
+	if show_divide:
+		if explorer is not None:
+			counts = explorer.divide(board, depth)
+		else:
+			counts = divide(board, depth)
+		for shorthand, nodes in sorted(counts.items()):
+			print("  {}: {}".format(shorthand, nodes), file=out)
+	return ok
+
+
+def main_cli():
+	"""Get options from the command-line flags, then run perft."""
+	opts = parser.parse_args()
+	if opts.fen:
+		runs = [('fen', opts.fen, None)]
+	else:
+		runs = [entry for entry in positions
+			if not opts.position or entry[0] in opts.position]
+	explorer = None
+	if opts.jobs > 1:
+		import parallel
+		explorer = parallel.TreeExplorer(opts.jobs)
+	ok = True
+	try:
+		for name, fen, expected in runs:
+			ok = run(name, fen, opts.depth, expected, opts.divide,
+				opts.validate, explorer=explorer) and ok
+	finally:
+		if explorer is not None:
+			explorer.close()
+	sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+	main_cli()
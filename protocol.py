@@ -0,0 +1,229 @@
+"""The messages chess games exchange over the network.
+
+Each message is one line of UTF-8 text ending in CRLF: a message type,
+then its fields separated by spaces.  The last field of MOVE, NAK, SYNC
+and HELLO may itself contain spaces.  Lines are read into a buffer and
+split on CRLF, so a message may arrive in several pieces, or several
+messages in one, without confusing either side.
+
+Both sides begin with HELLO and the protocol version; the side that
+assigns colors adds the color the other side plays.  Moves carry a
+sequence number that the answering ACK or NAK repeats, so a sender can
+keep working while its moves are in flight.
+
+A spectator's HELLO says 'spectator', and is followed by WATCH with a
+game number, or 0 for the newest game.  It is sent SYNC with the
+position, then each move as MOVE numbered by ply, which it does not
+answer.  RESIGN sent to a spectator names the color that resigned, and
+DRAW means a draw was agreed.
+
+When a server ends a game it sends RESULT to the players and the
+spectators before closing: the winning color, or 'draw', then the
+reason, such as 'white time' or 'draw stalemate'.
+"""
+from collections import namedtuple
+import select
+import threading
+import time
+
+VERSION = 1
+MAX_MESSAGE = 256
+
+HELLO = 'HELLO'
+MOVE = 'MOVE'
+ACK = 'ACK'
+NAK = 'NAK'
+RESIGN = 'RESIGN'
+DRAW = 'DRAW'
+PING = 'PING'
+PONG = 'PONG'
+SYNC = 'SYNC'
+WATCH = 'WATCH'
+RESULT = 'RESULT'
+
+# Whether each message type carries a number, and whether it carries text:
+# True if the text is required, False if it is optional, None if absent.
+fields = {
+	HELLO: (True, False),
+	MOVE: (True, True),
+	ACK: (True, None),
+	NAK: (True, False),
+	RESIGN: (False, False),
+	DRAW: (False, None),
+	PING: (True, None),
+	PONG: (True, None),
+	SYNC: (False, True),
+	WATCH: (True, None),
+	RESULT: (False, True),
+}
+
+Message = namedtuple('Message', 'kind number text')
+
+
+class ProtocolError(ValueError):
+	"""Raised for a message that does not follow the protocol."""
+
+
+def message(kind, number=None, text=None):
+	"""Create a message, checking that it has the fields its type needs."""
+	if kind not in fields:
+		raise ProtocolError("Unknown message type: " + kind)
+	has_number, has_text = fields[kind]
+	if has_number != (number is not None):
+		raise ProtocolError("Bad number for " + kind)
+	if has_text is None and text is not None or has_text and not text:
+		raise ProtocolError("Bad text for " + kind)
+	return Message(kind, number, text)
+
+
+def result_text(result):
+	"""Return the RESULT text for a (reason, winner) game result."""
+	reason, winner = result
+	return '{} {}'.format(winner or 'draw', reason)
+
+
+def parse_result(text):
+	"""Return the (reason, winner) game result sent in a RESULT message."""
+	winner, _, reason = text.partition(' ')
+	if winner not in ('white', 'black', 'draw') or not reason:
+		raise ProtocolError("Bad result: " + text)
+	return reason, None if winner == 'draw' else winner
+
+
+def encode(msg):
+	"""Return the bytes that send a message."""
+	parts = [msg.kind]
+	if msg.number is not None:
+		parts.append(str(msg.number))
+	if msg.text:
+		parts.append(msg.text)
+	data = ' '.join(parts).encode('UTF-8') + b'\r\n'
+	if len(data) > MAX_MESSAGE:
+		raise ProtocolError("Message too long")
+	return data
+
+
+def decode(line):
+	"""Return the message sent as a line, without its line ending."""
+	if isinstance(line, bytes):
+		try:
+			line = line.decode('UTF-8')
+		except UnicodeDecodeError:
+			raise ProtocolError("Message is not UTF-8")
+	kind, _, rest = line.strip().partition(' ')
+	if kind not in fields:
+		raise ProtocolError("Unknown message: " + line)
+	number = None
+	if fields[kind][0]:
+		field, _, rest = rest.partition(' ')
+		try:
+			number = int(field)
+		except ValueError:
+			raise ProtocolError("Bad number in message: " + line)
+	return message(kind, number, rest.strip() or None)
+
+
+class Decoder(object):
+	"""Collect received bytes and split them into messages."""
+
+	def __init__(self):
+		self.buffer = b''
+
+	def feed(self, data):
+		"""Add received bytes, returning every message now complete."""
+		self.buffer += data
+		lines = self.buffer.split(b'\r\n')
+		self.buffer = lines.pop()
+		# Each line is checked without its CRLF, which encode() counts.
+		if any(len(line) + 2 > MAX_MESSAGE for line in lines + [self.buffer]):
+			raise ProtocolError("Message too long")
+		return [decode(line) for line in lines if line.strip()]
+
+
+class Channel(object):
+	"""Messages over a connected socket.
+
+	Received messages are queued, so receive() returns them one at a time
+	however they were split into packets.  PINGs are answered as they
+	arrive, and PONGs dropped.  One thread may receive while another
+	sends.  Moves are numbered by send_move(), and last_received holds the
+	time.monotonic() time at which anything, even a PONG, last arrived."""
+
+	def __init__(self, sock):
+		self.sock = sock
+		self.decoder = Decoder()
+		self.received = []
+		self.next_number = 1
+		self.last_received = time.monotonic()
+		self.closed = False
+		self.send_lock = threading.Lock()
+
+	def send(self, kind, number=None, text=None):
+		data = encode(message(kind, number, text))
+		with self.send_lock:
+			self.sock.sendall(data)
+
+	def send_move(self, shorthand):
+		"""Send a move without waiting for its answer, returning its number."""
+		number = self.next_number
+		self.next_number += 1
+		self.send(MOVE, number, shorthand)
+		return number
+
+	def hello(self, color=None):
+		self.send(HELLO, VERSION, color)
+
+	def expect_hello(self, timeout=None):
+		"""Wait for the other side's HELLO, returning the color it gives us.
+
+		Raises ProtocolError if it speaks another version."""
+		msg = self.receive(timeout)
+		if msg is None or msg.kind != HELLO:
+			raise ProtocolError("Expected HELLO")
+		if msg.number != VERSION:
+			raise ProtocolError("Unsupported protocol version {}".format(
+				msg.number))
+		return msg.text
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def poll(self, timeout=0):
+		"""Read whatever has arrived, waiting at most timeout seconds.
+
+		Returns False once the connection has closed."""
+		if self.closed:
+			return False
+		readable, _, _ = select.select([self.sock], [], [], timeout)
+		if not readable:
+			return True
+		try:
+			data = self.sock.recv(4096)
+		except OSError:
+			data = b''
+		if not data:
+			self.closed = True
+			return False
+		self.last_received = time.monotonic()
+		for msg in self.decoder.feed(data):
+			if msg.kind == PING:
+				self.send(PONG, msg.number)
+			elif msg.kind != PONG:
+				self.received.append(msg)
+		return True
+
+	def receive(self, timeout=None):
+		"""Return the next message, or None if none arrives in time.
+
+		With no timeout, wait as long as it takes.  Raises ConnectionError
+		if the connection closes first."""
+		while not self.received:
+			if not self.poll(timeout):
+				raise ConnectionError("Connection closed")
+			if timeout is not None and not self.received:
+				return None
+		return self.received.pop(0)
+
+	def close(self):
+		self.closed = True
+		self.sock.close()
@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+"""Replay archived games and report the first illegal move in each.
+
+Games are read lazily, one at a time, from shorthand logs (one move per
+line as printed by chess_game.py --log, games separated by blank lines)
+or from PGN files.  Files are spread over worker processes.
+"""
+from __future__ import print_function
+import chess
+import argparse
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+pgn_tag = re.compile(r'\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+pgn_token = re.compile(r'\{|\}|\(|\)|;|\$\d+|\d+\.+|[^\s{}();]+')
+pgn_results = ('1-0', '0-1', '1/2-1/2', '*')
+
+
+class Game(object):
+	"""A game read from a file: its tags, moves and starting position.
+
+	notation is 'shorthand' or 'san', and says how the moves are written."""
+
+	def __init__(self, moves, notation, tags=None, line=None):
+		self.moves = moves
+		self.notation = notation
+		self.tags = tags or {}
+		self.line = line
+
+	@property
+	def fen(self):
+		return self.tags.get('FEN')
+
+
+def read_log(stream):
+	"""Yield each game of a shorthand log."""
+	moves, start = [], None
+	for number, line in enumerate(stream, 1):
+		line = line.strip()
+		if line:
+			if not moves:
+				start = number
+			moves.append(line)
+		elif moves:
+			yield Game(moves, 'shorthand', line=start)
+			moves = []
+	if moves:
+		yield Game(moves, 'shorthand', line=start)
+
+
+def read_pgn(stream):
+	"""Yield each game of a PGN file.
+
+	Comments, variations and numeric annotations are skipped."""
+	tags, moves, start = {}, [], None
+	comment = False
+	depth = 0
+	for number, line in enumerate(stream, 1):
+		if not comment and line.startswith('%'):
+			continue
+		stripped = line.strip()
+		if not comment and depth == 0 and stripped.startswith('['):
+			if moves:
+				yield Game(moves, 'san', tags, start)
+				tags, moves, start = {}, [], None
+			for name, value in pgn_tag.findall(stripped):
+				tags[name] = value.replace('\\"', '"').replace('\\\\', '\\')
+			if start is None:
+				start = number
+			continue
+		for token in pgn_token.findall(line):
+			if comment:
+				comment = token != '}'
+			elif token == '{':
+				comment = True
+			elif token == ';':
+				break
+			elif token == '(':
+				depth += 1
+			elif token == ')':
+				depth -= 1
+			elif depth or token[0] == '$' or token[0].isdigit() and (
+					token.endswith('.')):
+				continue
+			elif token in pgn_results:
+				yield Game(moves, 'san', tags, start or number)
+				tags, moves, start = {}, [], None
+			else:
+				if start is None:
+					start = number
+				moves.append(token)
+	if moves or tags:
+		yield Game(moves, 'san', tags, start)
+
+
+def read_games(stream, name=''):
+	"""Yield each game of a file, choosing the reader by the file name."""
+	reader = read_pgn if name.lower().endswith('.pgn') else read_log
+	return reader(stream)
+
+
+def first_illegal_move(game):
+	"""Replay a game, returning (ply, move, reason) for its first bad move.
+
+	Returns None if every move is legal."""
+	try:
+		if game.fen:
+			board = chess.board_from_fen(game.fen)
+		else:
+			board = chess.new_board()
+	except ValueError as e:
+		return 0, game.fen, str(e)
+	for ply, text in enumerate(game.moves):
+		try:
+			if game.notation == 'san':
+				move = chess.Move.from_san(board, text)
+			else:
+				move = chess.Move.from_shorthand(board, text)
+				if not move.is_legal():
+					return ply, text, "Illegal move"
+		except ValueError as e:
+			return ply, text, str(e)
+		move.make()
+	return None
+
+
+def validate_file(name):
+	"""Check every game of a file.
+
+	Returns the file name, the number of games and a list of
+	(game number, first line, ply, move, reason) for each bad game."""
+	games, failures = 0, []
+	with open(name) as stream:
+		for game in read_games(stream, name):
+			error = first_illegal_move(game)
+			if error is not None:
+				failures.append((games, game.line) + error)
+			games += 1
+	return name, games, failures
+
+
+parser = argparse.ArgumentParser(
+		description="Check every move of archived games.")
+parser.add_argument('files', nargs='+',
+		help="Shorthand logs, or PGN files ending in .pgn.")
+parser.add_argument('-j', '--jobs', type=int, default=None,
+		help="The number of worker processes (default: one per core).")
+
+
+def main_cli():
+	"""Validate the files named on the command line, reporting bad games."""
+	opts = parser.parse_args()
+	began = time.time()
+	total = bad = 0
+	with ProcessPoolExecutor(opts.jobs) as pool:
+		for name, games, failures in pool.map(validate_file, opts.files):
+			total += games
+			bad += len(failures)
+			for game, line, ply, move, reason in failures:
+				print("{}:{}: game {}, ply {}: {}: {}".format(
+					name, line, game + 1, ply + 1, move, reason))
+	elapsed = time.time() - began
+	rate = total / elapsed if elapsed else 0.0
+	print("{} games, {} with illegal moves, in {:.2f}s ({:.0f} games/s)"
+		.format(total, bad, elapsed, rate), file=sys.stderr)
+	sys.exit(1 if bad else 0)
+
+
+if __name__ == '__main__':
+	main_cli()